@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+# File: bench_linux_metrics.py
+# URL: https://github.com/kxr/check_linux_metrics
+#
+# Benchmarks the collectors of check_linux_metrics.py against synthetic /proc trees
+#
+#  Copyright (c) 2015 Khizer Naeem (http://kxr.me)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import time
+import os
+import shutil
+import tempfile
+
+# Keep the interim state of the benchmark runs apart, read by check_linux_metrics at import
+STATE_DIR = tempfile.mkdtemp( prefix='bench_state_' )
+os.environ['LINUX_METRICS_DIR'] = STATE_DIR
+
+import check_linux_metrics
+
+# Size of the synthetic /proc tree at scale 1
+PIDS = 100000
+DISKS = 1000
+INTERFACES = 5000
+CPUS = 256
+
+# comm values the scanner has to cope with, including spaces and parentheses
+COMMS = [ 'bash', 'kworker/0:1', 'Web Content', 'weird) S (name', 'python' ]
+STATES = 'RSSSSSSDZI'
+
+# Fixed size files that don't depend on the scale, copied from the running kernel when it has them
+HOST_FILES = [ 'meminfo', 'vmstat', 'net/snmp', 'net/netstat', 'pressure/cpu', 'pressure/memory', 'pressure/io' ]
+
+# Collectors benchmarked: name and check arguments; disku and cgroup are left out as they
+# read the real mounts and /sys/fs/cgroup
+BENCH_CHECKS = [
+	( 'cpu', [ 'cpu' ] ),
+	( 'cpu-cores', [ 'cpu', '--per-core' ] ),
+	( 'load', [ 'load' ] ),
+	( 'threads', [ 'threads' ] ),
+	( 'files', [ 'files' ] ),
+	( 'procs', [ 'procs' ] ),
+	( 'topprocs', [ 'topprocs' ] ),
+	( 'diskio', [ 'diskio', '*' ] ),
+	( 'memory', [ 'memory', '--extended' ] ),
+	( 'swap', [ 'swap' ] ),
+	( 'vmstat', [ 'vmstat' ] ),
+	( 'network', [ 'network', '*' ] ),
+	( 'netproto', [ 'netproto' ] ),
+	( 'pressure', [ 'pressure' ] )
+]
+
+# Lightweight checks whose process startup is measured with --startup
+STARTUP_CHECKS = [ [ 'load' ], [ 'threads' ], [ 'files' ] ]
+
+def write_file( path, content ):
+	if not os.path.exists( os.path.dirname( path ) ):
+		os.makedirs( os.path.dirname( path ) )
+	f = open( path, 'w' )
+	try:
+		f.write( content )
+	finally:
+		f.close()
+
+def make_procs( proc_root, count ):
+	# /proc/<pid>/stat and /proc/<pid>/task/<pid>/stat for count processes
+	for pid in range( 1, count + 1 ):
+		stat = str( pid ) + ' (' + COMMS[ pid % len( COMMS ) ] + ') ' + STATES[ pid % len( STATES ) ]
+		stat += ' 1 1 1 0 -1 4194560 1520 0 0 0 ' + str( pid % 97 ) + ' ' + str( pid % 13 ) + ' 0 0 20 0 1 0 ' + str( pid ) + ' 1024000 250 18446744073709551615\n'
+		os.makedirs( proc_root + '/' + str( pid ) + '/task/' + str( pid ) )
+		write_file( proc_root + '/' + str( pid ) + '/stat', stat )
+		write_file( proc_root + '/' + str( pid ) + '/task/' + str( pid ) + '/stat', stat )
+
+def write_stat( proc_root, scale, tick ):
+	# /proc/stat with the cpu counters advanced by tick, so that the cpu checks see time going by
+	pids = int( PIDS * scale )
+	cpus = max( int( CPUS * scale ), 1 )
+	ticks = [ x + tick * y for x, y in zip( [ 4705, 150, 1120, 16250, 520, 0, 25, 0, 0, 0 ], [ 5, 0, 2, 3, 0, 0, 0, 0, 0, 0 ] ) ]
+	stat = 'cpu  ' + ' '.join( [ str( x * cpus ) for x in ticks ] ) + '\n'
+	for i in range( cpus ):
+		stat += 'cpu' + str( i ) + ' ' + ' '.join( [ str( x ) for x in ticks ] ) + '\n'
+	stat += 'intr 0\nctxt 1990473\nbtime 1062191376\nprocesses ' + str( pids + tick ) + '\nprocs_running 2\nprocs_blocked 0\n'
+	write_file( proc_root + '/stat', stat )
+
+def make_tree( proc_root, scale ):
+	# A synthetic /proc with PIDS processes, DISKS disks, INTERFACES interfaces and CPUS cpus times scale
+	pids = int( PIDS * scale )
+	write_stat( proc_root, scale, 0 )
+	write_file( proc_root + '/loadavg', '0.50 0.40 0.30 2/' + str( pids ) + ' ' + str( pids ) + '\n' )
+	write_file( proc_root + '/sys/fs/file-nr', '2048\t0\t1048576\n' )
+	diskstats = ''
+	for i in range( int( DISKS * scale ) ):
+		diskstats += '   8 %7d sd%d 1520 30 61100 840 9310 6450 253900 31050 0 8120 31890 12 0 480 3 150 70\n' % ( i, i )
+	write_file( proc_root + '/diskstats', diskstats )
+	net_dev = 'Inter-|   Receive                                                |  Transmit\n'
+	net_dev += ' face |bytes    packets errs drop fifo frame compressed multicast|bytes    packets errs drop fifo colls carrier compressed\n'
+	for i in range( int( INTERFACES * scale ) ):
+		net_dev += '  veth%d: 1049861 9312 0 0 0 0 0 0 1049861 9312 0 0 0 0 0 0\n' % i
+	write_file( proc_root + '/net/dev', net_dev )
+	for name in HOST_FILES:
+		if os.path.exists( '/proc/' + name ):
+			write_file( proc_root + '/' + name, check_linux_metrics.read_file( '/proc/' + name ) )
+	make_procs( proc_root, pids )
+
+def read_io():
+	# ( read, write ) syscalls of this process so far, or None if /proc/self/io is not readable
+	try:
+		io = check_linux_metrics.parse_meminfo( check_linux_metrics.read_file( '/proc/self/io' ) )
+		return ( io['syscr'], io['syscw'] )
+	except ( IOError, OSError, KeyError ):
+		return None
+
+def bench_check( proc_root, scale, args, repeat, tick=0 ):
+	# Run the check repeat times in a child process after a first run saving the interim state,
+	# returns ( seconds, read syscalls, write syscalls ) per run, the peak rss (kB) of the child and
+	# the output of a timed run that returned UNKNOWN, None if there was none: a failing check is quick;
+	# between the runs the cpu counters are advanced past tick and the clock is let tick (/proc/uptime has
+	# a 10ms resolution on python 2), which is not measured
+	r, w = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close( r )
+		check_linux_metrics.PROC_ROOT = proc_root
+		argv = [ 'check_linux_metrics.py' ] + args
+		check_linux_metrics.get_check_result( argv )
+		elapsed = 0.0
+		calls = [ 0, 0 ]
+		error = None
+		for i in range( repeat ):
+			write_stat( proc_root, scale, tick + i + 1 )
+			time.sleep( 0.02 )
+			io_start = read_io()
+			start = time.time()
+			status_code, output = check_linux_metrics.get_check_result( argv )
+			elapsed += time.time() - start
+			if status_code == 3:
+				error = output
+			io_end = read_io()
+			if io_start is None or io_end is None:
+				calls = None
+			elif calls is not None:
+				calls = [ calls[0] + io_end[0] - io_start[0], calls[1] + io_end[1] - io_start[1] ]
+		result = '%f' % ( elapsed / repeat )
+		if calls is not None:
+			result += ' %f %f' % ( float( calls[0] ) / repeat, float( calls[1] ) / repeat )
+		if error is not None:
+			result += '\n' + error
+		os.write( w, result.encode( 'utf-8' ) )
+		os._exit( 0 )
+	os.close( w )
+	result = b''
+	while True:
+		chunk = os.read( r, 4096 )
+		if not chunk:
+			break
+		result += chunk
+	os.close( r )
+	rusage = os.wait4( pid, 0 )[2]
+	lines = result.decode( 'utf-8' ).split( '\n', 1 )
+	values = [ float( x ) for x in lines[0].split() ]
+	if len( values ) == 1:
+		values += [ None, None ]
+	return values + [ rusage.ru_maxrss, ( lines + [ None ] )[1] ]
+
+def bench( names, scale, repeat ):
+	# Returns the number of collectors that returned UNKNOWN
+	failed = 0
+	proc_root = tempfile.mkdtemp( prefix='bench_proc_' )
+	try:
+		start = time.time()
+		make_tree( proc_root, scale )
+		print ( 'synthetic /proc: %d pids, %d disks, %d interfaces, %d cpus (%.1f s to generate)' % ( int( PIDS * scale ),
+			int( DISKS * scale ), int( INTERFACES * scale ), max( int( CPUS * scale ), 1 ), time.time() - start ) )
+		print ( '%-12s %12s %12s %12s %12s' % ( 'collector', 'ms/run', 'read calls', 'write calls', 'peak rss kB' ) )
+		# the peak rss of a child doing nothing, the interpreter and the module
+		baseline = bench_check( proc_root, scale, [], 1 )
+		print ( '%-12s %12s %12s %12s %12d' % ( 'baseline', '-', '-', '-', baseline[3] ) )
+		# the counters only go forward across the collectors, a decrease is a counter reset to the checks
+		tick = 0
+		for name, args in BENCH_CHECKS:
+			if names and name not in names:
+				continue
+			elapsed, syscr, syscw, maxrss, error = bench_check( proc_root, scale, args, repeat, tick )
+			tick += repeat
+			calls = [ '-', '-' ]
+			if syscr is not None:
+				calls = [ '%.1f' % syscr, '%.1f' % syscw ]
+			row = '%-12s %12.3f %12s %12s %12d' % ( name, elapsed * 1000, calls[0], calls[1], maxrss )
+			# the time of a collector that failed is not the time of the collector
+			if error is not None:
+				failed += 1
+				row += '  UNKNOWN: ' + error.split( '\n', 1 )[0]
+			print ( row )
+	finally:
+		shutil.rmtree( proc_root )
+	return failed
+
+def bench_startup( repeat ):
+	# Wall time of a process running each lightweight check on the real /proc: run as a script the whole
+	# file is compiled every time, run as a module (-m) the bytecode cached in __pycache__ is used
+	import subprocess
+	directory = os.path.dirname( os.path.abspath( check_linux_metrics.__file__ ) )
+	env = dict( os.environ )
+	env.pop( 'PYTHONDONTWRITEBYTECODE', None )
+	commands = [ ( 'interpreter', [ sys.executable, '-c', 'pass' ] ) ]
+	for args in STARTUP_CHECKS:
+		commands.append( ( args[0] + ' script', [ sys.executable, directory + '/check_linux_metrics.py' ] + args ) )
+		commands.append( ( args[0] + ' module', [ sys.executable, '-m', 'check_linux_metrics' ] + args ) )
+	print ( '%-16s %12s' % ( 'startup', 'ms/run' ) )
+	devnull = open( os.devnull, 'w' )
+	try:
+		for name, command in commands:
+			# the first run writes the bytecode cache
+			subprocess.call( command, cwd=directory, env=env, stdout=devnull )
+			start = time.time()
+			for i in range( repeat ):
+				subprocess.call( command, cwd=directory, env=env, stdout=devnull )
+			print ( '%-16s %12.3f' % ( name, ( time.time() - start ) * 1000 / repeat ) )
+	finally:
+		devnull.close()
+
+if __name__ == '__main__':
+	# bench_linux_metrics.py [--scale=factor] [--repeat=runs] [collector ...]
+	# bench_linux_metrics.py --startup [--repeat=runs]
+	args = sys.argv[1:]
+	startup = check_linux_metrics.pop_flag( args, '--startup' )
+	scale = check_linux_metrics.pop_option( args, '--scale' )
+	repeat = check_linux_metrics.pop_option( args, '--repeat' )
+	try:
+		if startup:
+			bench_startup( int( repeat or 20 ) )
+		else:
+			failed = bench( args, float( scale or 1 ), int( repeat or 5 ) )
+	finally:
+		shutil.rmtree( STATE_DIR )
+	if not startup and failed:
+		print ( '%d collectors returned UNKNOWN' % failed )
+		sys.exit( 1 )
@@ -25,52 +25,866 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+# Only what every check needs is imported here, the rest where it is used: the lightweight checks
+# are run every few seconds and importing threading alone costs more than running them
 import sys
 import time
 import os
-import shutil
+try:
+	from _thread import _local as thread_local, allocate_lock
+except ImportError:
+	from thread import _local as thread_local, allocate_lock
+
+# Directory of the interim state and of the /proc tree the checks read,
+# overridable from the environment e.g. to run the checks against a synthetic tree
+INTERIM_DIR = os.environ.get( 'LINUX_METRICS_DIR', '/var/tmp/linux_metrics' )
+PROC_ROOT = os.environ.get( 'LINUX_METRICS_PROC', '/proc' )
+
+DAEMON_SOCKET = INTERIM_DIR + '/daemon.sock'
+# The daemon socket is accessible to its user and group only, and runs only these checks for its clients
+DAEMON_SOCKET_MODE = 0o660
+DAEMON_CHECKS = [ 'cpu', 'procs', 'topprocs', 'load', 'pressure', 'cgroup', 'threads', 'files', 'diskio', 'disku',
+	'memory', 'netproto', 'vmstat', 'swap', 'network' ]
+
+# Prometheus exporter: port, seconds a collection is reused by later scrapes, and the checks collected
+EXPORTER_PORT = 9120
+EXPORTER_TTL = 10
+EXPORTER_CHECKS = [ [ 'cpu' ], [ 'load' ], [ 'threads' ], [ 'files' ], [ 'procs' ], [ 'diskio', '*' ],
+	[ 'disku', 'all' ], [ 'memory' ], [ 'swap' ], [ 'vmstat' ], [ 'network', '*' ], [ 'netproto' ] ]
+
+# Interim counters of all checks are kept in one binary state file:
+#   header: magic, version, number of records
+#   record: key length, key, monotonic timestamp, number of counters, counters (unsigned 64 bit)
+# the record of STATE_BOOT_KEY holds the boot id the state was saved in, the state of another boot is dropped
+STATE_FILE = INTERIM_DIR + '/state'
+STATE_MAGIC = b'CLMS'
+STATE_VERSION = 1
+STATE_HEADER = '>4sHI'
+STATE_BOOT_KEY = 'boot_id'
+# Seconds to wait for the state file lock held by a concurrent check
+STATE_LOCK_TIMEOUT = 5
+# Seconds after which the interim values of a key not updated since (a device gone, a check no longer run) are dropped
+STATE_EXPIRE = 86400
+# The state updates of the keys checked with --window are also appended to a fixed size history file per key:
+#   header: magic, version, number of counters, number of slots, next slot, used slots, boot id (2x 64 bit),
+#           wall clock time of the last --window run reading it
+#   slot: monotonic timestamp, counters (unsigned 64 bit)
+HISTORY_DIR = INTERIM_DIR + '/history'
+HISTORY_MAGIC = b'CLMH'
+HISTORY_VERSION = 3
+HISTORY_HEADER = '>4sHHIIIQQd'
+HISTORY_SLOTS = 1024
+# Seconds after which a history not read by a --window run, or not written, is removed
+HISTORY_EXPIRE = 86400
+# Bytes a history file may take, a history of many counters (cpu --per-core on many cores) gets fewer slots
+HISTORY_MAX_SIZE = 4194304
+# The topprocs interim values, a ( pid, starttime, cpu ticks ) triplet per process, are too large for the
+# state file read and rewritten by every check, they are kept in their own file next to it:
+#   header: magic, version, number of counters (32 bit), monotonic timestamp, boot id (2x 64 bit)
+#   counters (unsigned 64 bit)
+TOPPROCS_MAGIC = b'CLMT'
+TOPPROCS_VERSION = 1
+TOPPROCS_HEADER = '>4sHIdQQ'
+# Most processes kept in the topprocs interim state (3MB)
+TOPPROCS_STATE_MAX = 131072
+
+# Bytes read from the start of a /proc/<pid>/stat file to get to the state: the pid, the comm in parentheses
+# (up to 64 bytes with the kernel thread names of recent kernels) and the state
+PROC_STAT_HEAD = 128
+
+STATUS_NAMES = [ 'OK', 'WARNING', 'CRITICAL', 'UNKNOWN' ]
+# Checks whose first argument names the monitored device, used for batch service names
+DEVICE_CHECKS = [ 'diskio', 'disku', 'network' ]
+# Seconds each check of a batch may take before it is reported as unknown
+COLLECT_TIMEOUT = 10
+# Counters that are 32 bit on some kernels and drivers wrap around at COUNTER_WRAP, see counter_deltas
+COUNTER_WRAP = 2 ** 32
+# Fields of the cpu lines of /proc/stat that only go back on a reset: user, system, idle; the others may go back
+# a little on a healthy host (iowait per proc(5), steal on some hypervisors), their decrease counts as none
+CPU_RESET_FIELDS = ( 0, 2, 3 )
+
+# Boot id of the running kernel as two 64 bit halves, read once by boot_id()
+BOOT_ID = None
+
+# Network interfaces in sysfs, their ifindex tells a recreated interface of the same name
+NET_SYSFS = '/sys/class/net'
+
+# Mount point of the cgroup hierarchy, and the metrics of each cgroup resource with their units;
+# the first one is the one the thresholds apply to
+CGROUP_ROOT = '/sys/fs/cgroup'
+CGROUP_METRICS = {
+	'cpu': [ ( 'usage', '%' ), ( 'user', '%' ), ( 'system', '%' ), ( 'throttled', '%' ) ],
+	'memory': [ ( 'used_pc', '%' ), ( 'current', ' MB' ), ( 'anon', ' MB' ), ( 'file', ' MB' ), ( 'limit', ' MB' ) ],
+	'io': [ ( 'read_MBps', ' MB/s' ), ( 'write_MBps', ' MB/s' ), ( 'read_iops', ' t/s' ), ( 'write_iops', ' t/s' ) ],
+	'procs': [ ( 'procs', '' ), ( 'threads', '' ) ]
+}
+# /proc/vmstat counters reported as rates by memory --extended: page faults and swap ins/outs
+MEMORY_VMSTAT_FIELDS = [ 'pgfault', 'pgmajfault', 'pswpin', 'pswpout' ]
+# /proc/vmstat counters of the vmstat check: major faults, swap ins/outs, pages scanned and reclaimed,
+# direct reclaim stalls and oom kills; the anon/file splits duplicate the per reclaimer counters
+VMSTAT_COUNTERS = [ 'pgmajfault', 'pswpin', 'pswpout', 'pgscan', 'pgsteal', 'allocstall', 'oom_kill' ]
+VMSTAT_SPLIT_EXCLUDE = [ 'pgscan_anon', 'pgscan_file', 'pgsteal_anon', 'pgsteal_file', 'pgscan_direct_throttle' ]
+# /proc/net/snmp and /proc/net/netstat counters of the netproto check, and the metrics its thresholds apply to
+NETPROTO_COUNTERS = [ 'Tcp:OutSegs', 'Tcp:RetransSegs', 'Tcp:ActiveOpens', 'Tcp:PassiveOpens',
+	'TcpExt:ListenOverflows', 'TcpExt:ListenDrops', 'Udp:RcvbufErrors' ]
+NETPROTO_THRESHOLDS = [ 'retrans', 'listen_drops', 'udp_rcvbuf_errors', 'estab' ]
+# Resources of the pressure stall information in /proc/pressure
+PRESSURE_RESOURCES = [ 'cpu', 'memory', 'io' ]
+# Seconds the statvfs of each mount may take in disku all, and the pseudo file systems it skips by default
+DISKU_TIMEOUT = 5
+DISKU_SKIP_FSTYPES = [ 'autofs', 'binfmt_misc', 'bpf', 'cgroup', 'cgroup2', 'configfs', 'debugfs', 'devpts',
+	'devtmpfs', 'efivarfs', 'fusectl', 'hugetlbfs', 'mqueue', 'nsfs', 'proc', 'pstore', 'rpc_pipefs',
+	'securityfs', 'selinuxfs', 'squashfs', 'sysfs', 'tracefs' ]
+# Mount points with a statvfs of disku all still running after its timeout, hung e.g. on a stale NFS mount:
+# it is not called again before that one returns, the daemon and the exporter would pile up hung threads
+STATVFS_PENDING = set()
+STATVFS_LOCK = allocate_lock()
+
+# Options of the check being run, per thread as the checks of a batch run concurrently:
+#   window: seconds the rates are computed over, set by the --window option
+#   profile: Profile of the check, set by the --profile option
+CHECK_OPTIONS = thread_local()
+
+# Contents of the /proc files read during a batch run, shared between the checks
+PROC_CACHE = None
+PROC_CACHE_LOCK = allocate_lock()
+
+# Buffer the large /proc files are read into with read_bytes, per thread and grown as needed
+READ_BUFFER = thread_local()
+READ_BUFFER_SIZE = 65536
+
+# High resolution sampler of the daemon and the exporter: seconds between samples and samples kept per metric
+SAMPLER_INTERVAL = 0.5
+SAMPLER_SIZE = 600
+# Seconds a disk or interface is sampled after the last check asking for its samples
+SAMPLER_EXPIRE = 3600
+SAMPLER = None
+
+# Phases of a check profiled with --profile, besides the total and the computing left of it:
+#   read: reading /proc, state: reading and writing the interim state and history
+PROFILE_PHASES = [ 'read', 'state' ]
+
+
+class PluginExit( Exception ):
+	# Raised by the check functions instead of printing and exiting directly,
+	# so that the same checks can be run in-process by the daemon
+	def __init__( self, status_code, output ):
+		Exception.__init__( self, output )
+		self.status_code = status_code
+		self.output = output
+
+def plugin_exit( status_code, status_outp, perfdata=None ):
+	output = status_outp
+	if perfdata is not None:
+		output += ' | ' + perfdata
+	raise PluginExit( status_code, output )
+
+def cpu_time():
+	# CPU seconds used by this thread, by the whole process where there is no per thread clock (python < 3.7)
+	if hasattr( time, 'thread_time' ):
+		return time.thread_time()
+	times = os.times()
+	return times[0] + times[1]
+
+class Profile( object ):
+	# Wall and cpu seconds and files opened by each phase of a check,
+	# a phase begun within another one (e.g. reading /proc/uptime while locking the state) counts in the outer one
+	def __init__( self ):
+		self.phases = dict( [ ( x, [ 0.0, 0.0, 0 ] ) for x in PROFILE_PHASES ] )
+		self.phase = None
+		self.depth = 0
+		self.start = None
+		self.lock = allocate_lock()
+
+	def begin( self, phase ):
+		if self.depth == 0:
+			self.phase = phase
+			self.start = ( time.time(), cpu_time() )
+		self.depth += 1
+
+	def end( self, opens ):
+		self.depth -= 1
+		times = self.phases[ self.phase ]
+		times[2] += opens
+		if self.depth == 0:
+			times[0] += time.time() - self.start[0]
+			times[1] += cpu_time() - self.start[1]
+
+	def merge( self, other ):
+		# Add the phases of the profile of a check run in another thread, the checks of a batch
+		self.lock.acquire()
+		try:
+			for x in PROFILE_PHASES:
+				for i in range( 3 ):
+					self.phases[x][i] += other.phases[x][i]
+		finally:
+			self.lock.release()
+
+	def finish( self, wall, cpu ):
+		# Set the total of the check, what the phases leave of it is computing: parsing, rates and output;
+		# the checks of a batch run concurrently, their phases may add up to more than its total
+		opens = sum( [ self.phases[x][2] for x in PROFILE_PHASES ] )
+		self.phases['total'] = [ wall, cpu, opens ]
+		self.phases['compute'] = [ max( wall - sum( [ self.phases[x][0] for x in PROFILE_PHASES ] ), 0.0 ),
+			max( cpu - sum( [ self.phases[x][1] for x in PROFILE_PHASES ] ), 0.0 ), 0 ]
+
+	def perfdata( self ):
+		perfdata = ''
+		for name in [ 'total' ] + PROFILE_PHASES + [ 'compute' ]:
+			wall, cpu, opens = self.phases[ name ]
+			perfdata += 'profile_' + name + '_wall=' + str( '%.3f' % ( wall * 1000 ) ) + 'ms '
+			perfdata += 'profile_' + name + '_cpu=' + str( '%.3f' % ( cpu * 1000 ) ) + 'ms '
+			if name != 'compute':
+				perfdata += 'profile_' + name + '_opens=' + str( opens ) + ' '
+		return perfdata[:-1]
+
+def profiled( phase ):
+	# Decorator counting each call, which opens one file, in the phase of the profile of the running check
+	def decorator( func ):
+		def wrapper( *args, **kwargs ):
+			profile = getattr( CHECK_OPTIONS, 'profile', None )
+			if profile is None:
+				return func( *args, **kwargs )
+			profile.begin( phase )
+			try:
+				return func( *args, **kwargs )
+			finally:
+				profile.end( 1 )
+		wrapper.__name__ = func.__name__
+		return wrapper
+	return decorator
+
+@profiled( 'read' )
+def read_file( path ):
+	#with open( path ) as f:
+	f = open( path, 'r' )
+	try:
+		return f.read()
+	finally:
+		f.close()
 
-INTERIM_DIR = '/var/tmp/linux_metrics'
-if not os.path.exists(INTERIM_DIR):
-	os.makedirs( INTERIM_DIR )
+def read_into( fd, buf, offset=0 ):
+	# Read from fd into buf at offset, straight into the buffer with os.readv (python 3.3+), returns the count
+	if hasattr( os, 'readv' ):
+		if offset == 0:
+			return os.readv( fd, [ buf ] )
+		return os.readv( fd, [ memoryview( buf )[ offset: ] ] )
+	data = os.read( fd, len( buf ) - offset )
+	buf[ offset:offset + len( data ) ] = data
+	return len( data )
+
+@profiled( 'read' )
+def read_bytes( path ):
+	# Content of a file as bytes, read with os.read into the reused buffer of the thread without the text layer:
+	# no decoding and no line objects, the parsers split the bytes once; /proc files report a size of 0,
+	# the buffer is doubled until a read does not fill it
+	buf = getattr( READ_BUFFER, 'buf', None )
+	if buf is None:
+		buf = READ_BUFFER.buf = bytearray( READ_BUFFER_SIZE )
+	fd = os.open( path, os.O_RDONLY )
+	try:
+		n = 0
+		while True:
+			count = read_into( fd, buf, n )
+			if count == 0:
+				break
+			n += count
+			if n == len( buf ):
+				buf.extend( bytearray( len( buf ) ) )
+	finally:
+		os.close( fd )
+	# one copy out of the buffer, slicing the bytearray first would copy twice
+	return memoryview( buf )[:n].tobytes()
+
+def to_str( data ):
+	# Content read as bytes as str, decoded in one go before parsing
+	if str is bytes:
+		return data
+	return data.decode( 'utf-8', 'replace' )
+
+def read_proc( path, binary=False ):
+	# Every /proc file is read only once per batch run, the lock makes the checks
+	# running concurrently wait for the first read instead of reading the file again;
+	# binary reads the content as bytes with read_bytes
+	reader = read_file
+	if binary:
+		reader = read_bytes
+	cache = PROC_CACHE
+	if cache is None:
+		return reader( path )
+	PROC_CACHE_LOCK.acquire()
+	try:
+		if ( path, binary ) not in cache:
+			cache[ ( path, binary ) ] = reader( path )
+		return cache[ ( path, binary ) ]
+	finally:
+		PROC_CACHE_LOCK.release()
+
+def monotonic():
+	# CLOCK_MONOTONIC is the same for all processes, it does not jump with the wall clock
+	if hasattr( time, 'monotonic' ):
+		return time.monotonic()
+	# the uptime is read around the batch cache of /proc, a cached clock would stop
+	return float( read_file( '/proc/uptime' ).split()[0] )
+
+@profiled( 'state' )
+def load_state():
+	# Returns { key: ( timestamp, [counters] ) }, an unreadable state file is treated as empty
+	import struct
+	state = {}
+	try:
+		f = open( STATE_FILE, 'rb' )
+		try:
+			data = f.read()
+		finally:
+			f.close()
+	except IOError:
+		return state
+	try:
+		magic, version, records = struct.unpack_from( STATE_HEADER, data, 0 )
+		if magic != STATE_MAGIC or version != STATE_VERSION:
+			return state
+		offset = struct.calcsize( STATE_HEADER )
+		for i in range( records ):
+			key_len = struct.unpack_from( '>H', data, offset )[0]
+			key = data[ offset+2 : offset+2+key_len ].decode( 'utf-8' )
+			offset += 2 + key_len
+			timestamp, n = struct.unpack_from( '>dH', data, offset )[0:2]
+			offset += 10
+			counters = list( struct.unpack_from( '>%dQ' % n, data, offset ) )
+			offset += 8 * n
+			state[ key ] = ( timestamp, counters )
+	except struct.error:
+		return {}
+	# The interim values saved before a reboot are meaningless: the counters and the monotonic clock restarted
+	boot = boot_id()
+	if STATE_BOOT_KEY in state and state[ STATE_BOOT_KEY ][1] != boot:
+		return {}
+	return state
+
+def make_interim_dir():
+	# The interim directory is created by the first write into it, importing the module has no side effects
+	if not os.path.isdir( INTERIM_DIR ):
+		try:
+			os.makedirs( INTERIM_DIR )
+		except OSError:
+			# created concurrently by another check
+			if not os.path.isdir( INTERIM_DIR ):
+				raise
+
+@profiled( 'state' )
+def lock_state():
+	# Updates of the state file are serialised with an advisory lock on a separate lock file,
+	# readers don't need it as the state file is always replaced atomically
+	import fcntl
+	make_interim_dir()
+	fd = os.open( STATE_FILE + '.lock', os.O_RDWR | os.O_CREAT, 0o644 )
+	deadline = monotonic() + STATE_LOCK_TIMEOUT
+	while True:
+		try:
+			fcntl.flock( fd, fcntl.LOCK_EX | fcntl.LOCK_NB )
+			return fd
+		except ( IOError, OSError ):
+			if monotonic() >= deadline:
+				os.close( fd )
+				plugin_exit( 3, 'Plugin Error: Timed out waiting for the state file lock' )
+			time.sleep( 0.01 )
+
+def unlock_state( fd ):
+	# Closing the file releases the lock
+	os.close( fd )
+
+@profiled( 'state' )
+def save_state( state ):
+	import struct
+	data = [ struct.pack( STATE_HEADER, STATE_MAGIC, STATE_VERSION, len( state ) ) ]
+	for key in state:
+		timestamp, counters = state[ key ]
+		key_bytes = key.encode( 'utf-8' )
+		data.append( struct.pack( '>H', len( key_bytes ) ) + key_bytes )
+		data.append( struct.pack( '>dH', timestamp, len( counters ) ) )
+		data.append( struct.pack( '>%dQ' % len( counters ), *counters ) )
+	# Write a temporary file and rename it over the state file, called with the state lock held
+	tmp_file = STATE_FILE + '.' + str( os.getpid() )
+	f = open( tmp_file, 'wb' )
+	try:
+		f.write( b''.join( data ) )
+	finally:
+		f.close()
+	os.rename( tmp_file, STATE_FILE )
 
+@profiled( 'state' )
+def load_topprocs_state():
+	# Returns ( timestamp, [counters] ) saved by the last topprocs run,
+	# or None if it is missing, unreadable or of another boot
+	import struct
+	try:
+		f = open( STATE_FILE + '.topprocs', 'rb' )
+		try:
+			data = f.read()
+		finally:
+			f.close()
+	except IOError:
+		return None
+	try:
+		magic, version, n, timestamp, boot_high, boot_low = struct.unpack_from( TOPPROCS_HEADER, data, 0 )
+		if magic != TOPPROCS_MAGIC or version != TOPPROCS_VERSION or [ boot_high, boot_low ] != boot_id():
+			return None
+		return ( timestamp, list( struct.unpack_from( '>%dQ' % n, data, struct.calcsize( TOPPROCS_HEADER ) ) ) )
+	except struct.error:
+		return None
+
+@profiled( 'state' )
+def save_topprocs_state( counters ):
+	# Replace the topprocs state file, under the state lock like the state file
+	import struct
+	boot = boot_id()
+	data = struct.pack( TOPPROCS_HEADER, TOPPROCS_MAGIC, TOPPROCS_VERSION, len( counters ), monotonic(), boot[0], boot[1] )
+	data += struct.pack( '>%dQ' % len( counters ), *counters )
+	fd = lock_state()
+	try:
+		tmp_file = STATE_FILE + '.topprocs.' + str( os.getpid() )
+		f = open( tmp_file, 'wb' )
+		try:
+			f.write( data )
+		finally:
+			f.close()
+		os.rename( tmp_file, STATE_FILE + '.topprocs' )
+	finally:
+		unlock_state( fd )
+
+def boot_id():
+	# [ high, low ] 64 bit halves of the boot id of the running kernel, [ 0, 0 ] where it is not available
+	global BOOT_ID
+	if BOOT_ID is None:
+		try:
+			value = int( read_file( PROC_ROOT + '/sys/kernel/random/boot_id' ).strip().replace( '-', '' ), 16 )
+			BOOT_ID = [ value >> 64, value & ( 2 ** 64 - 1 ) ]
+		except ( IOError, OSError, ValueError ):
+			BOOT_ID = [ 0, 0 ]
+	return BOOT_ID
+
+def get_state( key ):
+	# Returns ( timestamp, [counters] ) saved by the last run, or None
+	return get_interim( load_state(), key )
+
+def update_state( values ):
+	# Save { key: [counters] } in one update,
+	# the state is re-read under the lock so that concurrent updates of other keys are kept
+	fd = lock_state()
+	try:
+		state = load_state()
+		now = monotonic()
+		for key in list( state.keys() ):
+			if now - state[ key ][0] > STATE_EXPIRE:
+				del state[ key ]
+		for key in values:
+			state[ key ] = ( now, [ int( x ) for x in values[ key ] ] )
+		state[ STATE_BOOT_KEY ] = ( now, boot_id() )
+		save_state( state )
+		# only the keys checked with --window have a history
+		try:
+			histories = set( os.listdir( HISTORY_DIR ) )
+		except OSError:
+			histories = set()
+		for key in values:
+			if history_file( key )[ len( HISTORY_DIR ) + 1: ] in histories:
+				append_history( key, now, state[ key ][1] )
+	finally:
+		unlock_state( fd )
+
+def set_state( key, counters ):
+	update_state( { key: counters } )
+
+def history_file( key ):
+	return HISTORY_DIR + '/' + key.replace( '/', '_' )
+
+def history_slots( n ):
+	# Slots of the history of n counters: HISTORY_SLOTS, or as many as fit in HISTORY_MAX_SIZE
+	return max( min( HISTORY_SLOTS, HISTORY_MAX_SIZE // ( 8 + 8 * n ) ), 2 )
+
+def read_history_header( fd ):
+	# The header fields of an open history file, None if it is not a history file of this version
+	import struct
+	data = os.read( fd, struct.calcsize( HISTORY_HEADER ) )
+	if len( data ) != struct.calcsize( HISTORY_HEADER ):
+		return None
+	header = struct.unpack( HISTORY_HEADER, data )
+	if header[0] != HISTORY_MAGIC or header[1] != HISTORY_VERSION:
+		return None
+	return header
+
+@profiled( 'state' )
+def request_history( key ):
+	# Mark the history of the key as read by a --window run, creating it empty if it does not exist:
+	# from then on every update of the key is appended to it
+	import struct
+	now = time.time()
+	if not os.path.exists( HISTORY_DIR ):
+		make_interim_dir()
+		try:
+			os.mkdir( HISTORY_DIR )
+		except OSError:
+			# created concurrently by another check
+			if not os.path.isdir( HISTORY_DIR ):
+				raise
+	elif not os.path.exists( history_file( key ) ):
+		prune_history( now )
+	fd = os.open( history_file( key ), os.O_RDWR | os.O_CREAT, 0o644 )
+	try:
+		if read_history_header( fd ) is None:
+			boot = boot_id()
+			os.ftruncate( fd, 0 )
+			os.lseek( fd, 0, 0 )
+			os.write( fd, struct.pack( HISTORY_HEADER, HISTORY_MAGIC, HISTORY_VERSION, 0, HISTORY_SLOTS, 0, 0, boot[0], boot[1], now ) )
+		else:
+			# the read time is the last field of the header
+			os.lseek( fd, struct.calcsize( HISTORY_HEADER ) - 8, 0 )
+			os.write( fd, struct.pack( '>d', now ) )
+	finally:
+		os.close( fd )
+
+def prune_history( now ):
+	# Remove the histories no longer written (a device that is gone) or read by a --window run
+	for name in os.listdir( HISTORY_DIR ):
+		path = HISTORY_DIR + '/' + name
+		try:
+			if now - os.stat( path ).st_mtime > HISTORY_EXPIRE:
+				os.remove( path )
+		except OSError:
+			continue
+
+@profiled( 'state' )
+def append_history( key, timestamp, counters ):
+	# Write the sample into the next slot of the key's ring buffer file, in place through a shared mapping;
+	# the ring is (re)started when it holds a different number of counters or the samples of another boot,
+	# the file is removed when no --window run has read it for HISTORY_EXPIRE seconds
+	import mmap
+	import struct
+	slot = struct.Struct( '>d%dQ' % len( counters ) )
+	header_size = struct.calcsize( HISTORY_HEADER )
+	size = header_size + history_slots( len( counters ) ) * slot.size
+	fd = os.open( history_file( key ), os.O_RDWR )
+	try:
+		header = read_history_header( fd )
+		if header is None or time.time() - header[8] > HISTORY_EXPIRE:
+			os.remove( history_file( key ) )
+			return
+		requested = header[8]
+		if os.fstat( fd ).st_size != size:
+			os.ftruncate( fd, size )
+		m = mmap.mmap( fd, size )
+		try:
+			boot = boot_id()
+			magic, version, n, slots, head, count, boot_high, boot_low, requested = struct.unpack_from( HISTORY_HEADER, m, 0 )
+			if n != len( counters ) or slots != history_slots( n ) or [ boot_high, boot_low ] != boot:
+				n, slots, head, count = len( counters ), history_slots( len( counters ) ), 0, 0
+			slot.pack_into( m, header_size + head * slot.size, timestamp, *counters )
+			struct.pack_into( HISTORY_HEADER, m, 0, magic, version, n, slots, ( head + 1 ) % slots, min( count + 1, slots ), boot[0], boot[1], requested )
+		finally:
+			m.close()
+		# the mapping does not update the modification time reliably, prune_history goes by it
+		os.utime( history_file( key ), None )
+	finally:
+		os.close( fd )
+
+@profiled( 'state' )
+def get_history( key, window ):
+	# Returns ( timestamp, [counters] ) of the newest sample at least window seconds old,
+	# or of the oldest one if the history is shorter than the window, or None
+	import mmap
+	import struct
+	request_history( key )
+	try:
+		fd = os.open( history_file( key ), os.O_RDONLY )
+	except OSError:
+		return None
+	try:
+		try:
+			m = mmap.mmap( fd, 0, access=mmap.ACCESS_READ )
+		except ( ValueError, mmap.error ):
+			return None
+	finally:
+		os.close( fd )
+	try:
+		magic, version, n, slots, head, count, boot_high, boot_low, requested = struct.unpack_from( HISTORY_HEADER, m, 0 )
+		if count == 0 or [ boot_high, boot_low ] != boot_id():
+			return None
+		slot = struct.Struct( '>d%dQ' % n )
+		since = monotonic() - window
+		# Walk the samples from the newest to the oldest one
+		for i in range( count ):
+			offset = struct.calcsize( HISTORY_HEADER ) + ( ( head - 1 - i ) % slots ) * slot.size
+			timestamp = struct.unpack_from( '>d', m, offset )[0]
+			if timestamp <= since or i == count - 1:
+				sample = slot.unpack_from( m, offset )
+				return ( sample[0], list( sample[1:] ) )
+	finally:
+		m.close()
+
+def get_interim( state, key ):
+	# The interim values to compute the rates from: the last run's, or with --window the history sample
+	window = getattr( CHECK_OPTIONS, 'window', None )
+	if window is None:
+		return state.get( key )
+	interim = get_history( key, window )
+	if interim is None:
+		# the history of the key has just been started, the last run is all there is
+		return state.get( key )
+	return interim
+
+def counter_deltas( old, new, gauges=(), wraps=True, clamped=() ):
+	# Increase of each counter from old to new, None if the counters were reset (statistics cleared, device
+	# recreated under the same name): with wraps, for counters that are 32 bit on some kernels and drivers,
+	# a decrease from a value that fits 32 bits is taken for a counter wrap when the increase it implies is
+	# under half of the 32 bit range; any other decrease is a reset; the fields at the gauges indexes
+	# (e.g. I/Os in progress) are not counters, their plain difference is kept; the counters at the clamped
+	# indexes may go back, their decrease is an increase of 0
+	deltas = []
+	for i in range( len( new ) ):
+		a = old[i]
+		b = new[i]
+		if b < a and i in clamped:
+			b = a
+		elif b < a and i not in gauges:
+			if wraps and a < COUNTER_WRAP and b + COUNTER_WRAP - a < COUNTER_WRAP // 2:
+				b += COUNTER_WRAP
+			else:
+				return None
+		deltas.append( b - a )
+	return deltas
+
+def parse_window( window ):
+	# Seconds of a --window value like 90, 90s, 5m or 1h
+	units = { 's': 1, 'm': 60, 'h': 3600 }
+	try:
+		if window[-1:] in units:
+			return float( window[:-1] ) * units[ window[-1] ]
+		return float( window )
+	except ValueError:
+		plugin_exit( 3, 'Plugin Error: Invalide window: ' + window )
+
+def match_names( names, patterns ):
+	# Sorted names matching any of the given names or glob patterns
+	import fnmatch
+	matched = set()
+	for pattern in patterns:
+		if pattern in names:
+			matched.add( pattern )
+		else:
+			matched.update( [ x for x in names if fnmatch.fnmatchcase( x, pattern ) ] )
+	return sorted( matched )
+
+# Counters of /proc/net/dev after the interface name, and the ones that count packet errors
+NET_DEV_FIELDS = [ 'r_bytes','r_packets','r_errs','r_drop','r_fifo','r_frame','r_compressed','r_multicast',
+	't_bytes','t_packets','t_errs','t_drop','t_fifo','t_colls','t_carrier','t_compressed' ]
+NET_ERROR_FIELDS = [ 'r_errs','r_drop','r_fifo','r_frame',
+	't_errs','t_drop','t_fifo','t_colls','t_carrier' ]
+
+def parse_net_dev( content ):
+	# Index { interface: counters } of /proc/net/dev (bytes, decoded at once) built in one pass, only the names
+	# are split off: the counters are left as one string, split and converted by the caller for the interfaces it uses
+	interfaces = {}
+	for line in to_str( content ).split( '\n' ):
+		i = line.find( ':' )
+		if i > 0:
+			interfaces[ line[:i].strip() ] = line[ i+1: ]
+	return interfaces
+
+def parse_diskstats( content ):
+	# Index { device: ( major, minor, counters ) } of /proc/diskstats (bytes, decoded at once) built in one pass,
+	# only major, minor and name are split off: the counters are left as one string, split and converted by the caller
+	# for the devices it uses: reads, reads merged, sectors read, read time, writes, writes merged,
+	# sectors written, write time, I/Os in progress, I/O time, weighted I/O time, [discards,
+	# discards merged, sectors discarded, discard time, [flushes, flush time]]
+	disks = {}
+	for line in to_str( content ).split( '\n' ):
+		fields = line.split( None, 3 )
+		# the counters are separated by single spaces, partitions of kernels before 2.6.25 have only 4
+		if len( fields ) == 4 and fields[3].count( ' ' ) >= 10:
+			disks[ fields[2] ] = ( fields[0], fields[1], fields[3] )
+	return disks
+
+class RingBuffer( object ):
+	# Fixed size buffer of ( timestamp, value ) samples, the oldest sample is overwritten
+	def __init__( self, size ):
+		import array
+		self.times = array.array( 'd', [ 0.0 ] * size )
+		self.values = array.array( 'd', [ 0.0 ] * size )
+		self.size = size
+		self.count = 0
+		self.head = 0
+
+	def append( self, timestamp, value ):
+		self.times[ self.head ] = timestamp
+		self.values[ self.head ] = value
+		self.head = ( self.head + 1 ) % self.size
+		self.count = min( self.count + 1, self.size )
+
+	def since( self, timestamp ):
+		# Values of the samples taken at or after timestamp
+		values = []
+		for x in range( self.count ):
+			i = ( self.head - self.count + x ) % self.size
+			if self.times[i] >= timestamp:
+				values.append( self.values[i] )
+		return values
+
+def percentile( values, pct ):
+	# Nearest rank percentile of sorted values
+	rank = int( pct / 100.0 * len( values ) + 0.999999 )
+	return values[ max( rank, 1 ) - 1 ]
+
+class Sampler( object ):
+	# Reads /proc/stat, /proc/diskstats and /proc/net/dev every interval seconds in a thread and
+	# keeps the rates between consecutive reads in a ring buffer per metric, so that the checks
+	# run by the daemon or the exporter can report the peaks hidden in their sample period;
+	# the disks and interfaces are sampled from the first check asking for them until none has for SAMPLER_EXPIRE seconds
+	def __init__( self, interval=SAMPLER_INTERVAL, size=SAMPLER_SIZE ):
+		self.interval = interval
+		self.size = size
+		self.rings = {}
+		self.last = None
+		# { 'diskio:device' or 'net:interface': monotonic time of the last request }
+		self.requested = {}
+		import threading
+		self.lock = threading.Lock()
+		self.thread = threading.Thread( target=self.run )
+		self.thread.daemon = True
+
+	def start( self ):
+		self.thread.start()
+
+	def run( self ):
+		while True:
+			try:
+				self.sample()
+			except ( IOError, OSError ):
+				pass
+			time.sleep( self.interval )
+
+	def read( self, requested ):
+		# { metric: counter } of the counters we sample, cpu as ( busy, total ) ticks,
+		# of the requested disks and interfaces only
+		counters = {}
+		cpu = [ int( x ) for x in read_file( PROC_ROOT + '/stat' ).split( '\n', 1 )[0].split()[1:9] ]
+		counters['cpu:busy'] = sum( cpu ) - cpu[3]
+		counters['cpu:total'] = sum( cpu )
+		if [ x for x in requested if x.startswith( 'diskio:' ) ]:
+			disks = parse_diskstats( read_bytes( PROC_ROOT + '/diskstats' ) )
+			for device in disks:
+				if 'diskio:' + device in requested:
+					fields = disks[ device ][2].split()
+					counters[ 'diskio:' + device + ':read_sectors' ] = int( fields[2] )
+					counters[ 'diskio:' + device + ':write_sectors' ] = int( fields[6] )
+		if [ x for x in requested if x.startswith( 'net:' ) ]:
+			interfaces = parse_net_dev( read_bytes( PROC_ROOT + '/net/dev' ) )
+			for name in interfaces:
+				if 'net:' + name in requested:
+					fields = interfaces[ name ].split()
+					counters[ 'net:' + name + ':RX_MBps' ] = int( fields[0] ) / 1024.00 / 1024.00
+					counters[ 'net:' + name + ':TX_MBps' ] = int( fields[8] ) / 1024.00 / 1024.00
+		return counters
+
+	def sample( self ):
+		now = monotonic()
+		self.lock.acquire()
+		try:
+			for x in list( self.requested.keys() ):
+				if now - self.requested[ x ] > SAMPLER_EXPIRE:
+					del self.requested[ x ]
+			requested = set( self.requested )
+		finally:
+			self.lock.release()
+		counters = self.read( requested )
+		self.lock.acquire()
+		try:
+			if self.last is not None and now > self.last[0]:
+				period = now - self.last[0]
+				prev = self.last[1]
+				rates = {}
+				if counters['cpu:total'] > prev['cpu:total']:
+					rates['cpu'] = 100.0 * ( counters['cpu:busy'] - prev['cpu:busy'] ) / ( counters['cpu:total'] - prev['cpu:total'] )
+				for metric in counters:
+					if not metric.startswith( 'cpu:' ) and metric in prev:
+						rates[ metric ] = ( counters[ metric ] - prev[ metric ] ) / period
+				for metric in rates:
+					if metric not in self.rings:
+						self.rings[ metric ] = RingBuffer( self.size )
+					self.rings[ metric ].append( now, rates[ metric ] )
+				# the rings of the disks and interfaces gone or no longer requested go with them
+				for metric in list( self.rings.keys() ):
+					if metric != 'cpu' and metric not in counters:
+						del self.rings[ metric ]
+			self.last = ( now, counters )
+		finally:
+			self.lock.release()
+
+	def stats( self, metric, since ):
+		# { 'max', 'p95', 'p99' } of the samples of metric taken since the given time, or None;
+		# the disk or interface of the metric is sampled from now on
+		self.lock.acquire()
+		try:
+			if metric != 'cpu':
+				self.requested[ metric.rsplit( ':', 1 )[0] ] = monotonic()
+			if metric not in self.rings:
+				return None
+			values = sorted( self.rings[ metric ].since( since ) )
+		finally:
+			self.lock.release()
+		if not values:
+			return None
+		return { 'max': values[-1], 'p95': percentile( values, 95 ), 'p99': percentile( values, 99 ) }
+
+def device_prefix( prefix, device ):
+	# Record the device the perfdata labels starting with prefix belong to, the metric exports
+	# report it as a label of its own instead of a part of the metric name
+	devices = getattr( CHECK_OPTIONS, 'devices', None )
+	if devices is not None:
+		devices[ prefix ] = device
+	return prefix
+
+def sampled_perfdata( metric, label, since ):
+	# perfdata of the max, p95 and p99 the sampler has seen for metric since the given time,
+	# with a trailing space like the perfdata items built by the checks
+	if SAMPLER is None:
+		return ''
+	stats = SAMPLER.stats( metric, since )
+	if stats is None:
+		return ''
+	return ''.join( [ label + '_' + x + '=' + str( '%.2f' % stats[x] ) + ' ' for x in [ 'max', 'p95', 'p99' ] ] )
 
 def check_cpu( warn=None, crit=None ):
 	status_code = 3
 	status_outp =''
 	perfdata = ''
 
-	#Verify if the interim file exists, if not create it now
-	interim_file = INTERIM_DIR + '/' + 'proc_stat'
-	if not os.path.isfile( interim_file ):
-		shutil.copyfile( '/proc/stat', interim_file )
-		print ( 'This was the first run, run again to get values' )
-		sys.exit( 0 )
+	cpu_line = read_proc( PROC_ROOT + '/stat' ).split( '\n', 1 )[0].split()[1:]
 
-	# Get mtime of the interim file and calculate the sample period
-	sample_period = float( time.time() - os.path.getmtime( interim_file ) )
+	#Verify if the interim values exist, if not save them now
+	interim = get_state( 'cpu' )
+	if interim is None:
+		set_state( 'cpu', cpu_line )
+		plugin_exit( 0, 'This was the first run, run again to get values' )
 
-	# Get the deltas proc stats: interimfile - procfile(now)	
-	#with open( interim_file ) as f1:
-	f1 = open( interim_file, 'r' )
-	try:
-		line1 = f1.readline()
-	finally:
-		f1.close()
+	# Calculate the sample period from the interim timestamp
+	sample_period = monotonic() - interim[0]
 
-	if len(line1) == 0:
-		shutil.copyfile( '/proc/stat', interim_file )
-		print ( 'Something was wrong with the iterim_file, run again to get values' )
-		sys.exit( 0 )
+	if len( interim[1] ) != len( cpu_line ):
+		set_state( 'cpu', cpu_line )
+		plugin_exit( 0, 'Something was wrong with the interim values, run again to get values' )
 
-	#with open( '/proc/stat' ) as f2:
-	f2 = open( '/proc/stat', 'r' )
-	try:
-		line2 = f2.readline()
-	finally:
-		f2.close()
-	deltas = [int(b) - int(a) for a, b in zip(line1.split()[1:], line2.split()[1:])]
+	# Get the deltas proc stats: interim - procfile(now)
+	# the cpu times are 64 bit on every kernel, they don't wrap
+	clamped = set( [ i for i in range( len( cpu_line ) ) if i not in CPU_RESET_FIELDS ] )
+	deltas = counter_deltas( interim[1], [ int( x ) for x in cpu_line ], wraps=False, clamped=clamped )
+	if deltas is None:
+		set_state( 'cpu', cpu_line )
+		plugin_exit( 0, 'The cpu counters were reset, run again to get values' )
 	total = sum( deltas )
+	# A concurrent run has just updated the interim values, keep them for the next run
+	if total == 0:
+		plugin_exit( 0, 'Sample period too short, run again to get values' )
 	percents = [100 - (100 * (float(total - x) / total)) for x in deltas]
 
 	if len ( percents ) >= 7:
@@ -112,26 +926,108 @@ def check_cpu( warn=None, crit=None ):
 		if warn is not None and crit is not None:
 			perfdata += ';' + str(warn) + ';' + str(crit)
 		perfdata += ' '
+	#peaks within the sample period seen by the sampler
+	perfdata += sampled_perfdata( 'cpu', 'cpu', interim[0] )
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	#update the interim values
+	set_state( 'cpu', cpu_line )
+
+	plugin_exit( status_code, status_outp, perfdata )
+
+def check_cpu_cores( warn=None, crit=None, core_perfdata=False ):
+	status_code = 3
+	status_outp =''
+	perfdata = ''
+
+	# The first 8 fields of every cpuN line (user, nice, system, idle, iowait, irq, softirq, steal)
+	# are kept in one flat array, guest time is already accounted in user and nice
+	width = 8
+	cores = []
+	counters = []
+	for line in read_proc( PROC_ROOT + '/stat' ).splitlines():
+		if line.startswith( 'cpu' ) and not line.startswith( 'cpu ' ):
+			fields = line.split()
+			cores.append( fields[0] )
+			counters += [ int( x ) for x in fields[1:width+1] ] + [ 0 ] * ( width + 1 - len( fields ) )
+
+	#Verify if the interim values exist, if not save them now
+	interim = get_state( 'cpu:cores' )
+	if interim is None:
+		set_state( 'cpu:cores', counters )
+		plugin_exit( 0, 'This was the first run, run again to get values' )
+	if len( interim[1] ) != len( counters ):
+		set_state( 'cpu:cores', counters )
+		plugin_exit( 0, 'The number of cpu cores changed, run again to get values' )
+
+	# Calculate the sample period from the interim timestamp
+	sample_period = monotonic() - interim[0]
+
+	# Deltas of all the cores in one pass over the flat arrays, then the busy % of each core
+	clamped = set( [ i for i in range( len( counters ) ) if i % width not in CPU_RESET_FIELDS ] )
+	deltas = counter_deltas( interim[1], counters, wraps=False, clamped=clamped )
+	if deltas is None:
+		set_state( 'cpu:cores', counters )
+		plugin_exit( 0, 'The cpu counters were reset, run again to get values' )
+	totals = [ sum( deltas[ x : x + width ] ) for x in range( 0, len( deltas ), width ) ]
+	idles = deltas[ 3 : : width ]
+	if 0 in totals:
+		plugin_exit( 0, 'Sample period too short, run again to get values' )
+	busy = [ 100 - 100.0 * idle / total for idle, total in zip( idles, totals ) ]
+
+	c = {
+	'max': max( busy ),
+	'min': min( busy ),
+	'avg': sum( busy ) / len( busy )
+	}
+	c['imbalance'] = c['max'] - c['min']
+	hottest = cores[ busy.index( c['max'] ) ]
+	coolest = cores[ busy.index( c['min'] ) ]
+
+	status_outp = 'CPU Cores: ' + str( len( cores ) )
+	status_outp += ' Max: ' + str( '%.2f' % c['max'] ) + '% (' + hottest + ')'
+	status_outp += ' Min: ' + str( '%.2f' % c['min'] ) + '% (' + coolest + ')'
+	status_outp += ' Avg: ' + str( '%.2f' % c['avg'] ) + '%'
+	status_outp += ' Imbalance: ' + str( '%.2f' % c['imbalance'] ) + '%'
+	status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
+
+	# The thresholds apply to the hottest core
+	if warn is not None and crit is not None:
+		if float( c['max'] ) >= float( crit ):
+			status_code = 2
+			status_outp += ' (Critical ' + hottest + ')'
+		elif float( c['max'] ) >= float( warn ):
+			status_code = 1
+			status_outp += ' (Warning ' + hottest + ')'
+		else:
+			status_code = 0
+			status_outp += ' (OK)'
+	else:
+		status_code = 0
+
+	for x in [ 'max', 'min', 'avg', 'imbalance' ]:
+		perfdata += x + '=' + str( '%.2f' % c[x] ) + '%'
+		if warn is not None and crit is not None and x == 'max':
+			perfdata += ';' + str(warn) + ';' + str(crit)
+		perfdata += ' '
+	if core_perfdata:
+		for core, pct in zip( cores, busy ):
+			perfdata += core + '=' + str( '%.2f' % pct ) + '% '
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	#update the interim file
-	shutil.copyfile( '/proc/stat', interim_file )
+	#update the interim values
+	set_state( 'cpu:cores', counters )
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
 
 def check_load( warn=None, crit=None ):
 	status_code = 3
 	status_outp =''
 	perfdata = ''
 
-	#with open('/proc/loadavg') as f:
-	f = open('/proc/loadavg', 'r')
-	try:
-		line = f.readline()
-	finally:
-		f.close()
+	line = read_proc( PROC_ROOT + '/loadavg' )
 	load_avgs = [float(x) for x in line.split()[:3]]
 
 	load = {
@@ -175,20 +1071,328 @@ def check_load( warn=None, crit=None ):
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
+
+def parse_pressure( content ):
+	# { 'some': { 'avg10', 'avg60', 'avg300', 'total' }, 'full': ... } of a /proc/pressure file,
+	# the averages are percents and total is the stall time in microseconds
+	pressure = {}
+	for line in content.splitlines():
+		fields = line.split()
+		if fields:
+			pressure[ fields[0] ] = dict( [ ( x.split( '=' )[0], float( x.split( '=' )[1] ) ) for x in fields[1:] ] )
+	# cpu full is only reported since kernel 5.13
+	if 'full' not in pressure:
+		pressure['full'] = { 'avg10': 0.0, 'avg60': 0.0, 'avg300': 0.0, 'total': 0.0 }
+	return pressure
+
+def check_pressure( resource=None, warn=None, crit=None ):
+	status_code = 0
+	status_outp =''
+	perfdata = ''
+
+	if resource is None:
+		resources = PRESSURE_RESOURCES
+	elif resource in PRESSURE_RESOURCES:
+		resources = [ resource ]
+	else:
+		plugin_exit( 3, 'Plugin Error: Unknown pressure resource: (' + resource + ')' )
+
+	pressures = {}
+	for x in resources:
+		try:
+			pressures[x] = parse_pressure( read_proc( PROC_ROOT + '/pressure/' + x ) )
+		except ( IOError, OSError ):
+			plugin_exit( 3, 'Plugin Error: Pressure stall information not available (kernel 4.20+ with psi enabled)' )
+
+	state = load_state()
+	now = monotonic()
+	new_state = {}
+	first_run = []
+	psi_d = []
+	for x in resources:
+		counters = [ int( pressures[x]['some']['total'] ), int( pressures[x]['full']['total'] ) ]
+		state_key = 'pressure:' + x
+		new_state[ state_key ] = counters
+		#Verify if the interim values exist, if not save them now
+		interim = get_interim( state, state_key )
+		if interim is None or interim[0] >= now:
+			first_run.append( x )
+			continue
+
+		# Calculate the sample period from the interim timestamp
+		sample_period = now - interim[0]
+		# Share of the sample period some or all of the tasks were stalled, from the stall time in microseconds
+		d = {
+			'some': min( ( counters[0] - interim[1][0] ) / ( sample_period * 10000.0 ), 100.0 ),
+			'full': min( ( counters[1] - interim[1][1] ) / ( sample_period * 10000.0 ), 100.0 )
+		}
+		psi_d.append( ( x, sample_period, d ) )
+
+	#update the interim values of all the resources at once
+	update_state( new_state )
+
+	if not psi_d:
+		plugin_exit( 0, 'This was the first run, run again to get values: pressure(' + ','.join( first_run ) + ')' )
+
+	status_outp += 'Pressure'
+	for x, sample_period, d in psi_d:
+		status_outp += ' ' + x + ': some ' + str( '%.2f' % d['some'] ) + '% full ' + str( '%.2f' % d['full'] ) + '%'
+	status_outp += ' [t:' + str( '%.2f' % psi_d[0][1] ) + ']'
+	if first_run:
+		status_outp += ' (First run: ' + ','.join( first_run ) + ')'
+
+	#thresholds: some[,full] stall percents
+	if warn is not None and crit is not None:
+		for x, sample_period, d in psi_d:
+			for i, y in [ ( 0, 'some' ), ( 1, 'full' ) ]:
+				if i >= len( warn ) or warn[i] == '' or crit[i] == '':
+					continue
+				if d[y] >= float( crit[i] ):
+					status_code = 2
+					status_outp += ' (Critical ' + x + ' ' + y + ')'
+				elif d[y] >= float( warn[i] ):
+					if status_code < 1:
+						status_code = 1
+					status_outp += ' (Warning ' + x + ' ' + y + ')'
+		if status_code == 0:
+			status_outp += ' (OK)'
+
+	for x, sample_period, d in psi_d:
+		for i, y in [ ( 0, 'some' ), ( 1, 'full' ) ]:
+			perfdata += x + '_' + y + '=' + str( '%.2f' % d[y] ) + '%'
+			if warn is not None and crit is not None and i < len( warn ) and warn[i] != '' and crit[i] != '':
+				perfdata += ';' + str(warn[i]) + ';' + str(crit[i])
+			perfdata += ' '
+			# the kernel's own running averages
+			for z in [ 'avg10', 'avg60', 'avg300' ]:
+				perfdata += x + '_' + y + '_' + z + '=' + str( '%.2f' % pressures[x][y][z] ) + '% '
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	plugin_exit( status_code, status_outp, perfdata )
+
+def cgroup_root():
+	# The cgroup v2 hierarchy: mounted on /sys/fs/cgroup, or on /sys/fs/cgroup/unified in hybrid mode
+	for root in [ CGROUP_ROOT, CGROUP_ROOT + '/unified' ]:
+		if os.path.exists( root + '/cgroup.controllers' ):
+			return root
+	plugin_exit( 3, 'Plugin Error: cgroup v2 hierarchy not found under ' + CGROUP_ROOT )
+
+def cgroup_paths( root, patterns ):
+	# Sorted cgroup paths (relative to the root) matching any of the comma separated paths or glob patterns,
+	# e.g. system.slice/* for all the services; / is the root cgroup
+	import glob
+	paths = set()
+	for pattern in patterns.split( ',' ):
+		pattern = pattern.strip( '/' )
+		if pattern == '':
+			paths.add( '/' )
+			continue
+		for x in glob.glob( root + '/' + pattern ):
+			if os.path.isfile( x + '/cgroup.procs' ):
+				paths.add( x[ len( root ) + 1: ] )
+	return sorted( paths )
+
+def parse_flat_keyed( content ):
+	# { key: int } of a flat keyed cgroup file (cpu.stat, memory.stat, memory.events) of "key value" lines
+	values = {}
+	for line in content.splitlines():
+		fields = line.split()
+		if len( fields ) == 2:
+			values[ fields[0] ] = int( fields[1] )
+	return values
+
+def parse_io_stat( content ):
+	# [ rbytes, wbytes, rios, wios ] of io.stat summed over the devices, lines of "major:minor key=value ..."
+	totals = [ 0, 0, 0, 0 ]
+	keys = [ 'rbytes', 'wbytes', 'rios', 'wios' ]
+	for line in content.splitlines():
+		for x in line.split()[1:]:
+			key, value = x.split( '=', 1 )
+			if key in keys:
+				totals[ keys.index( key ) ] += int( value )
+	return totals
+
+def cgroup_value( value ):
+	# counts (procs, threads) are printed as they are, the rest with two decimals
+	if isinstance( value, int ):
+		return str( value )
+	return str( '%.2f' % value )
+
+def check_cgroup( resource, pattern, warn=None, crit=None ):
+	status_code = 0
+	status_outp =''
+	perfdata = ''
+
+	if resource not in CGROUP_METRICS:
+		plugin_exit( 3, 'Plugin Error: Unknown cgroup resource: (' + resource + ')' )
+	root = cgroup_root()
+	paths = cgroup_paths( root, pattern )
+	if not paths:
+		plugin_exit( 3, 'Plugin Error: cgroup not found: (' + pattern + ')' )
+	if len( paths ) == 1:
+		device_prefix( '', paths[0] )
+
+	#cpu and io are rates of the counters since the last run, kept per cgroup in the state file;
+	#memory and procs are current values
+	state = {}
+	if resource in [ 'cpu', 'io' ]:
+		state = load_state()
+	elif resource == 'memory':
+		meminfo = parse_meminfo( read_proc( PROC_ROOT + '/meminfo' ) )
+		mem_total = meminfo['MemTotal'] * 1024
+		mem_available = meminfo['MemAvailable'] * 1024
+	now = monotonic()
+	new_state = {}
+	first_run = []
+	cg_d = []
+	for path in paths:
+		directory = root
+		if path != '/':
+			directory += '/' + path
+		try:
+			if resource == 'cpu':
+				stat = parse_flat_keyed( read_file( directory + '/cpu.stat' ) )
+				# throttling is only reported with the cpu controller enabled
+				counters = [ stat['usage_usec'], stat['user_usec'], stat['system_usec'], stat.get( 'throttled_usec', 0 ) ]
+			elif resource == 'io':
+				counters = parse_io_stat( read_file( directory + '/io.stat' ) )
+			elif resource == 'memory':
+				# the root cgroup has no memory.current, nor a limit
+				if path == '/':
+					current = mem_total - mem_available
+					limit = 'max'
+				else:
+					current = int( read_file( directory + '/memory.current' ) )
+					limit = read_file( directory + '/memory.max' ).strip()
+				stat = parse_flat_keyed( read_file( directory + '/memory.stat' ) )
+			else:
+				procs = len( read_file( directory + '/cgroup.procs' ).split() )
+				threads = len( read_file( directory + '/cgroup.threads' ).split() )
+		except ( IOError, OSError, KeyError ):
+			# the cgroup has gone meanwhile or its controller is not enabled
+			continue
+
+		d = {}
+		if resource in [ 'cpu', 'io' ]:
+			state_key = 'cgroup:' + resource + ':' + path
+			new_state[ state_key ] = counters
+			#Verify if the interim values exist, if not save them now
+			interim = get_interim( state, state_key )
+			if interim is None or len( interim[1] ) != len( counters ) or interim[0] >= now:
+				first_run.append( path )
+				continue
+			# Calculate the sample period from the interim timestamp
+			sample_period = now - interim[0]
+			delta = [ b - a for a, b in zip( interim[1], counters ) ]
+			# the counters went back: the cgroup was removed and created again, start over
+			if min( delta ) < 0:
+				first_run.append( path )
+				continue
+			if resource == 'cpu':
+				# percents of one cpu, from microseconds
+				for i, x in enumerate( [ 'usage', 'user', 'system', 'throttled' ] ):
+					d[x] = delta[i] / ( sample_period * 10000.0 )
+			else:
+				d['read_MBps'] = delta[0] / 1024.00 / 1024.00 / sample_period
+				d['write_MBps'] = delta[1] / 1024.00 / 1024.00 / sample_period
+				d['read_iops'] = delta[2] / sample_period
+				d['write_iops'] = delta[3] / sample_period
+		elif resource == 'memory':
+			sample_period = 0
+			d['current'] = current / 1024.00 / 1024.00
+			d['anon'] = stat.get( 'anon', 0 ) / 1024.00 / 1024.00
+			d['file'] = stat.get( 'file', 0 ) / 1024.00 / 1024.00
+			# usage of the limit, or of the host memory for unlimited cgroups
+			if limit == 'max':
+				limit = mem_total
+			d['limit'] = int( limit ) / 1024.00 / 1024.00
+			d['used_pc'] = 0.0
+			if d['limit'] > 0:
+				d['used_pc'] = d['current'] / d['limit'] * 100
+		else:
+			sample_period = 0
+			d['procs'] = procs
+			d['threads'] = threads
+		cg_d.append( ( path, sample_period, d ) )
+
+	#update the interim values of all the cgroups at once
+	if new_state:
+		update_state( new_state )
+
+	if not cg_d and first_run:
+		plugin_exit( 0, 'This was the first run, run again to get values: cgroup ' + resource + '(' + ','.join( first_run ) + ')' )
+	if not cg_d:
+		plugin_exit( 3, 'Plugin Error: cgroup ' + resource + ' statistics not available: (' + pattern + ')' )
+
+	# The first metric is the one the thresholds apply to, io has read,write thresholds
+	metrics = CGROUP_METRICS[ resource ]
+	main = metrics[0][0]
+	if len( paths ) == 1:
+		path, sample_period, d = cg_d[0]
+		status_outp += path + ' ' + resource + ':'
+		for x, unit in metrics:
+			status_outp += ' ' + x + ' ' + cgroup_value( d[x] ) + unit
+	else:
+		# Summary of all the cgroups, with the busiest one
+		busiest = max( cg_d, key=lambda x: x[2][ main ] )
+		status_outp += str( len( cg_d ) ) + ' cgroups ' + resource + ':'
+		status_outp += ' Busiest: ' + busiest[0] + ' (' + main + ' ' + cgroup_value( busiest[2][ main ] ) + metrics[0][1] + ')'
+		if first_run:
+			status_outp += ' (First run: ' + ','.join( first_run ) + ')'
+	if cg_d[0][1] > 0:
+		status_outp += ' [t:' + str( '%.2f' % cg_d[0][1] ) + ']'
+
+	if warn is not None and crit is not None:
+		for path, sample_period, d in cg_d:
+			if len( cg_d ) == 1:
+				label = ''
+			else:
+				label = ' ' + path
+			values = [ d[ main ] ]
+			if resource == 'io':
+				values = [ d['read_MBps'], d['write_MBps'] ]
+			if True in [ values[i] >= float( crit[i] ) for i in range( len( values ) ) ]:
+				status_code = 2
+				status_outp += ' (Critical' + label + ')'
+			elif True in [ values[i] >= float( warn[i] ) for i in range( len( values ) ) ]:
+				if status_code < 1:
+					status_code = 1
+				status_outp += ' (Warning' + label + ')'
+		if status_code == 0:
+			status_outp += ' (OK)'
+
+	for path, sample_period, d in cg_d:
+		# perfdata labels are prefixed with the cgroup if there are more than one
+		if len( paths ) == 1:
+			prefix = ''
+		else:
+			prefix = path.strip( '/' ).replace( '/', '_' ).replace( '.', '_' ) + '_'
+			if prefix == '_':
+				prefix = 'root_'
+			device_prefix( prefix, path )
+		for x, unit in metrics:
+			perfdata += prefix + x + '=' + cgroup_value( d[x] ) + ( unit if unit == '%' else '' )
+			if warn is not None and crit is not None:
+				if x == main and resource != 'io':
+					perfdata += ';' + str(warn[0]) + ';' + str(crit[0])
+				elif x == 'read_MBps':
+					perfdata += ';' + str(warn[0]) + ';' + str(crit[0])
+				elif x == 'write_MBps':
+					perfdata += ';' + str(warn[1]) + ';' + str(crit[1])
+			perfdata += ' '
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	plugin_exit( status_code, status_outp, perfdata )
 
 def check_threads( warn=None, crit=None ):
 	status_code = 3
 	status_outp =''
 	perfdata = ''
 
-	#with open('/proc/loadavg') as f:
-	f = open('/proc/loadavg', 'r')
-	try:
-		line = f.readline()
-	finally:
-		f.close()
+	line = read_proc( PROC_ROOT + '/loadavg' )
 	t = line.split()[3]
 	threads = {
 	'running': t.split('/')[0],
@@ -219,20 +1423,14 @@ def check_threads( warn=None, crit=None ):
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
 
 def check_openfiles( warn=None, crit=None ):
 	status_code = 3
 	status_outp = ''
 	perfdata = ''
 
-	#with open('/proc/sys/fs/file-nr') as f:
-	f = open('/proc/sys/fs/file-nr', 'r')
-	try:
-		line = f.readline()
-	finally:
-		f.close()
+	line = read_proc( PROC_ROOT + '/sys/fs/file-nr' )
 	fd = [int(x) for x in line.split()]
 
 	ofiles = {
@@ -266,56 +1464,98 @@ def check_openfiles( warn=None, crit=None ):
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
 
 
-def check_procs( warn=None, crit=None ):
+def iter_proc_stats( proc_root=None, threads=False, size=PROC_STAT_HEAD ):
+	# Yields ( pid, buf, n ) with the first n bytes of the stat file of every process (or thread),
+	# read into one reused buffer of the given size: consume it before the next iteration
+	if proc_root is None:
+		proc_root = PROC_ROOT
+	buf = bytearray( size )
+	#the directory listings and the reads are profiled, not the consumer of the yielded values
+	profile = getattr( CHECK_OPTIONS, 'profile', None )
+	if profile is not None:
+		profile.begin( 'read' )
+	try:
+		if hasattr( os, 'scandir' ):
+			pids = [ x.name for x in os.scandir( proc_root ) if x.name.isdigit() ]
+		else:
+			pids = [ x for x in os.listdir( proc_root ) if x.isdigit() ]
+	finally:
+		if profile is not None:
+			profile.end( 1 )
+	for pid in pids:
+		if threads:
+			if profile is not None:
+				profile.begin( 'read' )
+			try:
+				paths = [ proc_root + '/' + pid + '/task/' + x + '/stat' for x in os.listdir( proc_root + '/' + pid + '/task' ) ]
+			except OSError:
+				paths = []
+			if profile is not None:
+				profile.end( 1 )
+		else:
+			paths = [ proc_root + '/' + pid + '/stat' ]
+		for path in paths:
+			if profile is not None:
+				profile.begin( 'read' )
+			try:
+				fd = os.open( path, os.O_RDONLY )
+				try:
+					n = read_into( fd, buf )
+				finally:
+					os.close( fd )
+			except ( IOError, OSError ):
+				# the process has exited
+				n = -1
+			if profile is not None:
+				profile.end( 1 )
+			if n >= 0:
+				yield ( pid, buf, n )
+
+def scan_procs( proc_root=None, threads=False ):
+	# Count the processes (or threads) in each state, returns ( total, { state: count } )
+	# Only the start of each stat file is needed: the state follows the last ')'
+	# closing the comm field, which may itself contain spaces and parentheses
+	counts = {}
+	total = 0
+	for pid, buf, n in iter_proc_stats( proc_root, threads ):
+		i = buf.rfind( b')', 0, n )
+		if i < 0 or i + 2 >= n:
+			continue
+		state = buf[ i + 2 ]
+		counts[ state ] = counts.get( state, 0 ) + 1
+		total += 1
+	return ( total, dict( [ ( chr( x ), counts[x] ) for x in counts ] ) )
+
+def check_procs( warn=None, crit=None, threads=False ):
 	status_code = 3
 	status_outp =''
 	perfdata = ''
 
-	forks = 0
-	#Verify if the interim file exists, if not create it now
-	interim_file = INTERIM_DIR + '/' + 'proc_stat_processes'
-	if not os.path.isfile( interim_file ):
-		shutil.copyfile( '/proc/stat', interim_file )
-		print ( 'This was the first run, run again to get values' )
-		sys.exit( 0 )
-	# Get mtime of the interim file and calculate the sample period
-	sample_period = float( time.time() - os.path.getmtime( interim_file ) )
-	# Get the deltas proc stats interimfile - procfile(now)	
 	curr_forks = 0
-	for file in [ '/proc/stat', interim_file ]:
-		#with open( file ) as f:
-		f = open( file, 'r' )
-		try:
-			for line in f:
-				if line.startswith( 'processes ' ):
-					if file == '/proc/stat':
-						curr_forks = int( line.split()[1] )
-					elif file == interim_file:
-						forks = curr_forks - int( line.split()[1] )	
-		finally:
-			f.close()
+	for line in read_proc( PROC_ROOT + '/stat' ).splitlines():
+		if line.startswith( 'processes ' ):
+			curr_forks = int( line.split()[1] )
+			break
+	#Verify if the interim values exist, if not save them now
+	interim = get_state( 'procs' )
+	if interim is None:
+		set_state( 'procs', [ curr_forks ] )
+		plugin_exit( 0, 'This was the first run, run again to get values' )
+	# Calculate the sample period from the interim timestamp
+	sample_period = monotonic() - interim[0]
+	if sample_period <= 0:
+		plugin_exit( 0, 'Sample period too short, run again to get values' )
+	# Get the deltas proc stats interim - procfile(now)
+	deltas = counter_deltas( interim[1], [ curr_forks ] )
+	if deltas is None:
+		set_state( 'procs', [ curr_forks ] )
+		plugin_exit( 0, 'The fork counter was reset, run again to get values' )
+	forks = deltas[0]
 	forks_ps = float ( forks / sample_period )
-	states_procs = {}
-	p_total = 0
-	for proc_dir in os.listdir( '/proc' ):
-		if proc_dir.isdigit():
-			p_total += 1
-			try:
-				#with open( '/proc/' + proc_dir + '/stat' ) as f:
-				f = open( '/proc/' + proc_dir + '/stat', 'r' )
-				try:
-					line = f.readline().split()[1:3]
-				finally:
-					f.close()
-			except:
-				continue
-			if line[1] not in states_procs:
-				states_procs[ line[1] ] = []
-			states_procs[ line[1] ].append( line[0] )
+	p_total, states_procs = scan_procs( threads=threads )
 	p = {
 	'total': p_total,
 	'forks': forks_ps,
@@ -327,15 +1567,15 @@ def check_procs( warn=None, crit=None ):
 	}
 	for state in states_procs:
 		if state == 'R':
-			p['running'] += len( states_procs[state] )
+			p['running'] += states_procs[state]
 		elif state == 'S':
-			p['sleeping'] += len( states_procs[state] )
+			p['sleeping'] += states_procs[state]
 		elif state == 'D':
-			p['waiting'] += len( states_procs[state] )
+			p['waiting'] += states_procs[state]
 		elif state == 'Z':
-			p['zombie'] += len( states_procs[state] )
+			p['zombie'] += states_procs[state]
 		else:
-			p['others'] += len( states_procs[state] )
+			p['others'] += states_procs[state]
 
 	status_outp += 'Total:' + str( p['total'] ) + ' Running:' + str( p['running'] ) + ' Sleeping:' + str( p['sleeping'] ) + ' Waiting:' + str( p['waiting'] )
 	#status_outp += ' Zombie:' + str( p['zombie'] ) + ' Others:' + str( p['others'] ) + ' New_Forks:' + format( p['forks'], '.2f' ) + '/s'
@@ -374,79 +1614,201 @@ def check_procs( warn=None, crit=None ):
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	#update the interim file
-	shutil.copyfile( '/proc/stat', interim_file )
+	#update the interim values
+	set_state( 'procs', [ curr_forks ] )
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
 
-def check_diskio( dev, warn=None, crit=None ):
+def check_topprocs( count=5, warn=None, crit=None ):
 	status_code = 3
-	status_outp =''
+	status_outp = ''
 	perfdata = ''
 
-	#Process the device
-	if dev.startswith( '/' ):
-		real_path = os.path.realpath( dev )
-		if str( real_path[:5] ) != '/dev/':
-			print ( 'Plugin Error: Block device not found: ' + dev )
-			sys.exit( 3 )
+	import heapq
+	clk_tck = float( os.sysconf( 'SC_CLK_TCK' ) )
+	page_mb = os.sysconf( 'SC_PAGE_SIZE' ) / 1024.00 / 1024.00
+
+	# ( pid, starttime ) -> ( comm, cpu ticks, rss pages ), the starttime tells a reused pid apart
+	procs = {}
+	for pid, buf, n in iter_proc_stats( size=1024 ):
+		i = buf.rfind( b')', 0, n )
+		fields = bytes( buf[ i + 2 : n ] ).split()
+		# utime, stime, starttime and rss are fields 14, 15, 22 and 24 of the stat file
+		if i < 0 or len( fields ) < 22:
+			continue
+		comm = bytes( buf[ buf.find( b'(', 0, i ) + 1 : i ] ).decode( 'utf-8', 'replace' )
+		procs[ ( int( pid ), int( fields[19] ) ) ] = ( comm, int( fields[11] ) + int( fields[12] ), int( fields[21] ) )
+
+	# The interim values are saved as ( pid, starttime, cpu ticks ) triplets of the live processes,
+	# if there are too many, the ones with the least cpu time are evicted
+	keys = list( procs.keys() )
+	if len( keys ) > TOPPROCS_STATE_MAX:
+		keys = heapq.nlargest( TOPPROCS_STATE_MAX, keys, key=lambda x: procs[x][1] )
+	counters = []
+	for key in keys:
+		counters += [ key[0], key[1], procs[ key ][1] ]
+
+	#Verify if the interim values exist, if not save them now
+	#(the process list is too large for the history, --window does not apply)
+	interim = load_topprocs_state()
+	if interim is None:
+		save_topprocs_state( counters )
+		plugin_exit( 0, 'This was the first run, run again to get values' )
+
+	# Calculate the sample period from the interim timestamp
+	sample_period = monotonic() - interim[0]
+	if sample_period <= 0:
+		plugin_exit( 0, 'Sample period too short, run again to get values' )
+	prev_ticks = {}
+	for x in range( 0, len( interim[1] ) - 2, 3 ):
+		prev_ticks[ ( interim[1][x], interim[1][x+1] ) ] = interim[1][x+2]
+	# Processes started after the last run used all their cpu time since then
+	last_run = interim[0] * clk_tck
+
+	cpu_pcts = []
+	for key in procs:
+		comm, ticks, rss = procs[ key ]
+		if key in prev_ticks:
+			delta = ticks - prev_ticks[ key ]
+		elif key[1] >= last_run:
+			delta = ticks
 		else:
-			device = real_path [5:]
-	else:
-		device = dev
-	#Check if the device exist
-	#with open( '/proc/diskstats' ) as f2:
-	f2 = open( '/proc/diskstats', 'r' )
-	try:
-		proc_content = f2.read()
-	finally:
-		f2.close()
-	sep = '%s ' % device
-	found = False
-	for line in proc_content.splitlines():
-		if sep in line:
-			found = True
-			proc_line = line.strip().split(sep)[1].split()
-			break
-	if not found:
-		print ( 'Plugin Error: Block device not found: ('+device+')' )
-		sys.exit( 3 )
+			continue
+		cpu_pcts.append( ( delta / clk_tck / sample_period * 100, key[0], comm ) )
+	# Bounded heaps instead of sorting the whole process table
+	top_cpu = heapq.nlargest( count, cpu_pcts )
+	top_rss = heapq.nlargest( count, [ ( procs[x][2] * page_mb, x[0], procs[x][0] ) for x in procs ] )
+
+	status_outp += 'Top CPU: ' + ', '.join( [ comm + '(' + str( pid ) + ') ' + str( '%.2f' % pct ) + '%' for pct, pid, comm in top_cpu ] )
+	status_outp += ' Top RSS: ' + ', '.join( [ comm + '(' + str( pid ) + ') ' + str( '%.2f' % mb ) + 'MB' for mb, pid, comm in top_rss ] )
+	status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
+
+	# The thresholds apply to the cpu usage of the busiest process
+	if warn is not None and crit is not None:
+		top_pct = 0
+		if top_cpu:
+			top_pct = top_cpu[0][0]
+		if top_pct >= float( crit ):
+			status_code = 2
+			status_outp += ' (Critical)'
+		elif top_pct >= float( warn ):
+			status_code = 1
+			status_outp += ' (Warning)'
+		else:
+			status_code = 0
+			status_outp += ' (OK)'
 	else:
-		#Now the the device is found:
-		#Verify if the interim file exists, if not create it now
-		interim_file = INTERIM_DIR + '/' + 'proc_diskstats_' + str(device).replace( '/', '_' )
-		if not os.path.isfile( interim_file ):
-			shutil.copyfile( '/proc/diskstats', interim_file )
-			print ( 'This was the first run, run again to get values: diskio('+device+')' )
-			sys.exit( 0 )
-
-		# Get mtime of the interim file and calculate the sample period
-		sample_period = float( time.time() - os.path.getmtime( interim_file ) )
-
-		#with open( interim_file ) as f1:
-		f1 = open( interim_file, 'r' )
-		try:
-			interim_content = f1.read()
-		finally:
-			f1.close()
+		status_code = 0
 
-		for line in interim_content.splitlines():
-			if sep in line:
-				interim_line = line.strip().split(sep)[1].split()
-				break
+	# perfdata labels are the ranks, the processes are named in the status output
+	seq = 1
+	for pct, pid, comm in top_cpu:
+		perfdata += 'cpu' + str( seq ) + '=' + str( '%.2f' % pct ) + '%'
+		if warn is not None and crit is not None and seq == 1:
+			perfdata += ';' + str(warn) + ';' + str(crit)
+		perfdata += ' '
+		seq += 1
+	seq = 1
+	for mb, pid, comm in top_rss:
+		perfdata += 'rss' + str( seq ) + '=' + str( '%.2f' % mb ) + ' '
+		seq += 1
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	#update the interim values
+	save_topprocs_state( counters )
+
+	plugin_exit( status_code, status_outp, perfdata )
+
+def check_diskio( dev, warn=None, crit=None ):
+	status_code = 3
+	status_outp =''
+	perfdata = ''
+
+	#Process the devices: comma separated device names, paths or glob patterns
+	patterns = []
+	for x in dev.split( ',' ):
+		if x.startswith( '/' ):
+			real_path = os.path.realpath( x )
+			if str( real_path[:5] ) != '/dev/':
+				plugin_exit( 3, 'Plugin Error: Block device not found: ' + x )
+			patterns.append( real_path[5:] )
+		else:
+			patterns.append( x )
+	#Index all devices in one pass and pick the requested ones
+	disks = parse_diskstats( read_proc( PROC_ROOT + '/diskstats', binary=True ) )
+	devices = match_names( disks, patterns )
+	if not devices:
+		plugin_exit( 3, 'Plugin Error: Block device not found: ('+','.join( patterns )+')' )
+	if len( devices ) == 1:
+		device_prefix( '', devices[0] )
+
+	state = load_state()
+	now = monotonic()
+	new_state = {}
+	first_run = []
+	reset = []
+	disk_d = []
+	for device in devices:
+		major, minor, fields = disks[ device ]
+		counters = [ int( x ) for x in fields.split() ]
+		# the device number is kept after the counters, a device of the same name may be another one
+		identity = os.makedev( int( major ), int( minor ) )
+		state_key = 'diskio:' + device
+		new_state[ state_key ] = counters + [ identity ]
+		#Verify if the interim values exist, if not save them now
+		interim = get_interim( state, state_key )
+		if interim is None or len( interim[1] ) != len( counters ) + 1 or interim[0] >= now:
+			first_run.append( device )
+			continue
+		# another device or counters reset: start over from the current values
+		# (the I/Os in progress are a gauge, not a counter)
+		delta = None
+		if interim[1][-1] == identity:
+			delta = counter_deltas( interim[1][:-1], counters, gauges=( 8, ) )
+		if delta is None:
+			reset.append( device )
+			continue
+
+		# Calculate the sample period from the interim timestamp
+		sample_period = now - interim[0]
 
 		#compute deltas; refer: https://www.kernel.org/doc/Documentation/iostats.txt
 		# each delta is divided by the sample period which gives us values in per second;
 		d = {
-			'read_operations': ( int( proc_line[0] ) - int( interim_line[0] ) ) / sample_period,
-			'read_sectors':  ( int( proc_line[2] ) - int( interim_line[2] ) ) / sample_period,
-			'read_time': ( int( proc_line[3] ) - int( interim_line[3] ) ) / sample_period,
-			'write_operations': ( int( proc_line[4] ) - int( interim_line[4] ) ) / sample_period,
-			'write_sectors': ( int( proc_line[6] ) - int( interim_line[6] ) ) / sample_period,
-			'write_time': ( int( proc_line[7] ) - int( interim_line[7] ) ) / sample_period
+			'read_operations': delta[0] / sample_period,
+			'read_sectors':  delta[2] / sample_period,
+			'read_time': delta[3] / sample_period,
+			'write_operations': delta[4] / sample_period,
+			'write_sectors': delta[6] / sample_period,
+			'write_time': delta[7] / sample_period,
+			# time spent doing I/Os (ms) over the sample period
+			'util': min( delta[9] / ( sample_period * 10.0 ), 100.0 ),
+			# average time (ms) an I/O took, queueing included
+			'await': 0.0,
+			# average number of I/Os in the queue, from the weighted time spent doing I/Os
+			'queue': delta[10] / ( sample_period * 1000.0 )
 		}
-
+		if delta[0] + delta[4] > 0:
+			d['await'] = float( delta[3] + delta[7] ) / ( delta[0] + delta[4] )
+		# discard fields since kernel 4.18, flush fields since 5.5
+		if len( delta ) >= 15:
+			d['discard_operations'] = delta[11] / sample_period
+			d['discard_sectors'] = delta[13] / sample_period
+		if len( delta ) >= 17:
+			d['flush_operations'] = delta[15] / sample_period
+		disk_d.append( ( device, sample_period, d ) )
+
+	#update the interim values of all the devices at once
+	update_state( new_state )
+
+	if not disk_d and reset:
+		plugin_exit( 0, 'The counters were reset, run again to get values: diskio('+','.join( first_run + reset )+')' )
+	if not disk_d:
+		plugin_exit( 0, 'This was the first run, run again to get values: diskio('+','.join( first_run )+')' )
+
+	if len( devices ) == 1:
+		device, sample_period, d = disk_d[0]
 		status_outp += dev
 		status_outp += '(' + device + ')'
 		#status_outp += ' Read: ' + format( d['read_sectors'], '.2f' ) + ' sec/s (' + format( d['read_operations'], '.2f' ) + ' t/s)'
@@ -454,38 +1816,67 @@ def check_diskio( dev, warn=None, crit=None ):
 		#status_outp += ' [t:' + format( sample_period, '.2f' ) + ']'
 		status_outp += ' Read: ' + str( '%.2f' % d['read_sectors'] ) + ' sec/s (' + str( '%.2f' % d['read_operations'] ) + ' t/s)'
 		status_outp += ' Write: ' + str( '%.2f' % d['write_sectors'] ) + ' sec/s (' + str( '%.2f' % d['write_operations'] ) + ' t/s)'
+		status_outp += ' Util: ' + str( '%.2f' % d['util'] ) + '%'
 		status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
+	else:
+		# Summary of all the devices, with the busiest one
+		busiest = max( disk_d, key=lambda x: x[2]['util'] )
+		status_outp += str( len( disk_d ) ) + ' devices'
+		status_outp += ' Read: ' + str( '%.2f' % sum( [ x[2]['read_sectors'] for x in disk_d ] ) ) + ' sec/s'
+		status_outp += ' Write: ' + str( '%.2f' % sum( [ x[2]['write_sectors'] for x in disk_d ] ) ) + ' sec/s'
+		status_outp += ' Busiest: ' + busiest[0] + ' (' + str( '%.2f' % busiest[2]['util'] ) + '%)'
+		status_outp += ' [t:' + str( '%.2f' % busiest[1] ) + ']'
+		if first_run:
+			status_outp += ' (First run: ' + ','.join( first_run ) + ')'
+		if reset:
+			status_outp += ' (Counters reset: ' + ','.join( reset ) + ')'
 
-		if warn is not None and crit is not None:
+	if warn is not None and crit is not None:
+		status_code = 0
+		for device, sample_period, d in disk_d:
+			if len( disk_d ) == 1:
+				label = ''
+			else:
+				label = ' ' + device
 			if float( d['read_sectors'] ) >= float( crit[0] ) or float( d['write_sectors'] ) >= float( crit[1] ):
 				status_code = 2
-				status_outp += ' (Critical)'
+				status_outp += ' (Critical' + label + ')'
 			elif float( d['read_sectors'] ) >= float( warn[0] ) or float( d['write_sectors'] ) >= float( warn[1] ):
-				status_code = 1
-				status_outp += ' (Warning)'
-			else:
-				status_code = 0
-				status_outp += ' (OK)'
+				if status_code < 1:
+					status_code = 1
+				status_outp += ' (Warning' + label + ')'
+		if status_code == 0:
+			status_outp += ' (OK)'
+	else:
+		status_code = 0
+
+	for device, sample_period, d in disk_d:
+		# perfdata labels are prefixed with the device if there are more than one
+		if len( devices ) == 1:
+			prefix = ''
 		else:
-			status_code = 0
-	
-		for x in [ 'read_operations', 'read_sectors', 'read_time', 'write_operations', 'write_sectors', 'write_time' ]:
+			prefix = device_prefix( device.replace( '/', '_' ) + '_', device )
+		for x in [ 'read_operations', 'read_sectors', 'read_time', 'write_operations', 'write_sectors', 'write_time',
+			'util', 'await', 'queue', 'discard_operations', 'discard_sectors', 'flush_operations' ]:
+			if x not in d:
+				continue
 			#perfdata += x + '=' + format( d[x], '.2f' ) 
-			perfdata += x + '=' + str( '%.2f' % d[x] ) 
+			perfdata += prefix + x + '=' + str( '%.2f' % d[x] ) 
+			if x == 'util':
+				perfdata += '%'
 			if warn is not None and crit is not None:
 				if x == 'read_sectors':
 					perfdata += ';' + str(warn[0]) + ';' + str(crit[0])
 				elif x == 'write_sectors':
 					perfdata += ';' + str(warn[1]) + ';' + str(crit[1])
 			perfdata += ' '
-		#remove last space
-		perfdata = perfdata[:-1]
-	
-		#update the interim file
-		shutil.copyfile( '/proc/diskstats', interim_file )
-	
-		print status_outp + ' | ' + perfdata
-		sys.exit( status_code )
+		#peaks within the sample period seen by the sampler
+		for x in [ 'read_sectors', 'write_sectors' ]:
+			perfdata += sampled_perfdata( 'diskio:' + device + ':' + x, prefix + x, now - sample_period )
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	plugin_exit( status_code, status_outp, perfdata )
 
 def check_disku( mount, warn=None, crit=None):
 	status_code = 3
@@ -493,11 +1884,11 @@ def check_disku( mount, warn=None, crit=None):
 	perfdata = ''
 
 	
+	device_prefix( '', mount )
 	if os.path.ismount( mount ):
 		statvfs = os.statvfs( mount )
 	else:
-		print ( 'Plugin Error: Mount point not valid: (' + mount + ')' )
-		sys.exit( 3 )
+		plugin_exit( 3, 'Plugin Error: Mount point not valid: (' + mount + ')' )
 
 	if statvfs is not None:
 		du = {
@@ -532,36 +1923,160 @@ def check_disku( mount, warn=None, crit=None):
 		if warn is not None and crit is not None:
 			perfdata += ';' + str(warn) + ';' + str(crit)
 	
-		print status_outp + ' | ' + perfdata
-		sys.exit( status_code )
+		plugin_exit( status_code, status_outp, perfdata )
+
+def parse_mountinfo( content ):
+	# [ ( mount point, fstype ) ] of /proc/self/mountinfo, a mount point mounted over keeps the last entry;
+	# fields: id parent major:minor root mount_point options [optional fields] - fstype source super_options
+	mounts = {}
+	order = []
+	for line in content.splitlines():
+		fields = line.split()
+		if '-' not in fields:
+			continue
+		# spaces, tabs, newlines and backslashes in mount points are octal escaped
+		mount = fields[4]
+		for code, char in [ ( '\\040', ' ' ), ( '\\011', '\t' ), ( '\\012', '\n' ), ( '\\134', '\\' ) ]:
+			mount = mount.replace( code, char )
+		if mount not in mounts:
+			order.append( mount )
+		mounts[ mount ] = fields[ fields.index( '-' ) + 1 ]
+	return [ ( x, mounts[x] ) for x in order ]
+
+def pending_statvfs( mount ):
+	# os.statvfs of a mount point registered in STATVFS_PENDING until it returns
+	try:
+		return os.statvfs( mount )
+	finally:
+		STATVFS_LOCK.acquire()
+		try:
+			STATVFS_PENDING.discard( mount )
+		finally:
+			STATVFS_LOCK.release()
 
-def check_memory ( warn=None, crit=None ):
-	status_code = 3
+def check_disku_all( warn=None, crit=None, fstypes=None, include=None, exclude=None, timeout=DISKU_TIMEOUT ):
+	status_code = 0
 	status_outp =''
 	perfdata = ''
-	mem = {}
-	#with open('/proc/meminfo') as f:
-	f = open('/proc/meminfo', 'r')
-	try:
-		for line in f:
-			if line.startswith( 'MemTotal: ' ):
-				mem['total'] = int( line.split()[1] )
-			elif line.startswith( 'Active: ' ):
-				mem['active'] = int( line.split()[1] )
-			elif line.startswith( 'MemFree: ' ):
-				mem['free'] = int( line.split()[1] )
-			elif line.startswith( 'Cached: ' ):
-				mem['cached'] = int( line.split()[1] )
-			elif line.startswith('Buffers: ' ):
-				mem['buffers'] = int( line.split()[1] )
+
+	#Pick the mounts: by file system type (pseudo file systems are skipped by default),
+	#then by the include and exclude mount point patterns
+	mounts = parse_mountinfo( read_proc( PROC_ROOT + '/self/mountinfo' ) )
+	if fstypes is None:
+		mounts = [ x for x in mounts if x[1] not in DISKU_SKIP_FSTYPES ]
+	else:
+		mounts = [ x for x in mounts if x[1] in fstypes ]
+	names = [ x[0] for x in mounts ]
+	if include is not None:
+		names = [ x for x in names if x in match_names( names, include ) ]
+	if exclude is not None:
+		names = [ x for x in names if x not in match_names( names, exclude ) ]
+
+	#statvfs all the mounts at once, each with its own timeout, but for the ones still hung since an earlier run
+	STATVFS_LOCK.acquire()
+	try:
+		hung = [ x for x in names if x in STATVFS_PENDING ]
+		names = [ x for x in names if x not in STATVFS_PENDING ]
+		STATVFS_PENDING.update( names )
 	finally:
-		f.close()
+		STATVFS_LOCK.release()
+	results = run_concurrently( pending_statvfs, [ ( x, ) for x in names ], timeout )
+	du_d = []
+	failed = []
+	for mount, statvfs in zip( names, results ):
+		if statvfs is None or isinstance( statvfs, Exception ):
+			failed.append( mount )
+			continue
+		# file systems without blocks (e.g. a mounted namespace file) have no usage
+		if statvfs.f_blocks == 0:
+			continue
+		du = {
+		'size':  float( statvfs.f_frsize * statvfs.f_blocks / 1024.00 / 1024 / 1024 ),    # Size of filesystem
+		'avail': float( statvfs.f_frsize * statvfs.f_bavail / 1024.00 / 1024 / 1024 )     # Available free
+		}
+		du['used_pc'] = ( du['size'] - du['avail'] ) / du['size'] * 100
+		# some file systems (btrfs) don't report inodes
+		if statvfs.f_files > 0:
+			du['inodes_used_pc'] = float( statvfs.f_files - statvfs.f_ffree ) / statvfs.f_files * 100
+		du_d.append( ( mount, du ) )
+
+	if not du_d and not failed:
+		plugin_exit( 3, 'Plugin Error: No mount points found' )
+
+	status_outp += str( len( du_d ) ) + ' mounts'
+	if du_d:
+		fullest = max( du_d, key=lambda x: x[1]['used_pc'] )
+		status_outp += ' Fullest: ' + fullest[0] + ' (' + str( '%.2f' % fullest[1]['used_pc'] ) + '%)'
+		inodes_d = [ x for x in du_d if 'inodes_used_pc' in x[1] ]
+		if inodes_d:
+			fullest = max( inodes_d, key=lambda x: x[1]['inodes_used_pc'] )
+			status_outp += ' Inodes: ' + fullest[0] + ' (' + str( '%.2f' % fullest[1]['inodes_used_pc'] ) + '%)'
+
+	#the thresholds apply to the space and the inodes used on every mount
+	if warn is not None and crit is not None:
+		for mount, du in du_d:
+			used_pc = max( du['used_pc'], du.get( 'inodes_used_pc', 0 ) )
+			if used_pc >= float( crit ):
+				status_code = 2
+				status_outp += ' (Critical ' + mount + ')'
+			elif used_pc >= float( warn ):
+				if status_code < 1:
+					status_code = 1
+				status_outp += ' (Warning ' + mount + ')'
+	for mount in failed:
+		status_code = worst_status( status_code, 3 )
+		status_outp += ' (Unknown ' + mount + ': statvfs failed or timed out)'
+	for mount in hung:
+		status_code = worst_status( status_code, 3 )
+		status_outp += ' (Unknown ' + mount + ': statvfs still hung since an earlier run)'
+	if status_code == 0 and warn is not None and crit is not None:
+		status_outp += ' (OK)'
+
+	for mount, du in du_d:
+		# perfdata labels are the mount points, root for /
+		prefix = mount.strip( '/' ).replace( '/', '_' ).replace( ' ', '_' )
+		if prefix == '':
+			prefix = 'root'
+		device_prefix( prefix + '_', mount )
+		for x in [ 'used_pc', 'inodes_used_pc' ]:
+			if x not in du:
+				continue
+			perfdata += prefix + '_' + x[:-3] + '=' + str( '%.2f' % du[x] ) + '%'
+			if warn is not None and crit is not None:
+				perfdata += ';' + str(warn) + ';' + str(crit)
+			perfdata += ' '
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	plugin_exit( status_code, status_outp, perfdata )
+
+def parse_meminfo( content ):
+	# { key: value } of /proc/meminfo in one pass, the values are in kB except the HugePages_ counts
+	meminfo = {}
+	for line in content.splitlines():
+		fields = line.split()
+		if len( fields ) >= 2:
+			meminfo[ fields[0].rstrip( ':' ) ] = int( fields[1] )
+	return meminfo
+
+def check_memory ( warn=None, crit=None, extended=False ):
+	status_code = 3
+	status_outp =''
+	perfdata = ''
+	mem = parse_meminfo( read_proc( PROC_ROOT + '/meminfo' ) )
+	# MemAvailable is the kernel's estimate of the memory available without swapping (since 3.14),
+	# it accounts for the reclaimable slab and leaves out the shared memory that can not be dropped
+	if 'MemAvailable' in mem:
+		available = mem['MemAvailable']
+	else:
+		available = mem['MemFree'] + mem['Cached'] + mem['Buffers']
 	m = {
-	'total':   float( mem['total'] / 1024.00 ),
-	'active':  float( mem['active'] / 1024.00 ),
-	'cached':  float( (mem['cached'] + mem['buffers']) / 1024.00 ),
-	'used': float( (mem['total'] - mem['free'] - mem['cached'] - mem['buffers']) / 1024.00 ),
-	'used_p': float( (mem['total'] - mem['free'] - mem['cached'] - mem['buffers']) ) / float( mem['total'] ) * 100.00
+	'total':   float( mem['MemTotal'] / 1024.00 ),
+	'active':  float( mem['Active'] / 1024.00 ),
+	'cached':  float( (mem['Cached'] + mem['Buffers']) / 1024.00 ),
+	'available': float( available / 1024.00 ),
+	'used': float( (mem['MemTotal'] - available) / 1024.00 ),
+	'used_p': float( (mem['MemTotal'] - available) ) / float( mem['MemTotal'] ) * 100.00
 	}
 
 	#status_outp += 'Memory Used: ' + format( m['used'], '.2f' ) + 'MB / ' + format( m['total'], '.2f' ) + 'MB (' + format( m['used_p'], '.2f' ) + '%)'
@@ -580,7 +2095,30 @@ def check_memory ( warn=None, crit=None ):
 	else:
 		status_code = 0
 
-	for x in [ 'used', 'cached', 'active' ]:
+	perf_keys = [ 'used', 'cached', 'active' ]
+	if extended:
+		m['slab'] = mem.get( 'Slab', 0 ) / 1024.00
+		m['sreclaimable'] = mem.get( 'SReclaimable', 0 ) / 1024.00
+		m['shmem'] = mem.get( 'Shmem', 0 ) / 1024.00
+		m['hugepages'] = ( mem.get( 'HugePages_Total', 0 ) - mem.get( 'HugePages_Free', 0 ) ) * mem.get( 'Hugepagesize', 0 ) / 1024.00
+		m['dirty'] = mem.get( 'Dirty', 0 ) / 1024.00
+		m['writeback'] = mem.get( 'Writeback', 0 ) / 1024.00
+		perf_keys += [ 'available', 'slab', 'sreclaimable', 'shmem', 'hugepages', 'dirty', 'writeback' ]
+		# Paging rates from the /proc/vmstat counters since the last run
+		vmstat = parse_flat_keyed( read_proc( PROC_ROOT + '/vmstat' ) )
+		counters = [ vmstat.get( x, 0 ) for x in MEMORY_VMSTAT_FIELDS ]
+		now = monotonic()
+		interim = get_state( 'memory:vmstat' )
+		set_state( 'memory:vmstat', counters )
+		if interim is not None and len( interim[1] ) == len( counters ) and now > interim[0]:
+			sample_period = now - interim[0]
+			for i in range( len( counters ) ):
+				m[ MEMORY_VMSTAT_FIELDS[i] ] = max( counters[i] - interim[1][i], 0 ) / sample_period
+			perf_keys += MEMORY_VMSTAT_FIELDS
+		else:
+			status_outp += ' (First run: paging rates)'
+
+	for x in perf_keys:
 		#perfdata += x + '=' + format( m[x], '.2f' )
 		perfdata += x + '=' + str( '%.2f' % m[x] )
 		if x == 'used':
@@ -595,31 +2133,102 @@ def check_memory ( warn=None, crit=None ):
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
+
+def vmstat_counters( vmstat ):
+	# The VMSTAT_COUNTERS of a parsed /proc/vmstat; counters split by zone or by reclaimer
+	# (pgscan_kswapd, allocstall_normal, ...) are summed up
+	counters = []
+	for name in VMSTAT_COUNTERS:
+		counters.append( sum( [ vmstat[x] for x in vmstat if ( x == name or x.startswith( name + '_' ) ) and x not in VMSTAT_SPLIT_EXCLUDE ] ) )
+	return counters
+
+def check_vmstat( warn=None, crit=None ):
+	status_code = 3
+	status_outp =''
+	perfdata = ''
+
+	counters = vmstat_counters( parse_flat_keyed( read_proc( PROC_ROOT + '/vmstat' ) ) )
+
+	#Verify if the interim values exist, if not save them now
+	interim = get_state( 'vmstat' )
+	if interim is None or len( interim[1] ) != len( counters ):
+		set_state( 'vmstat', counters )
+		plugin_exit( 0, 'This was the first run, run again to get values' )
+
+	# Calculate the sample period from the interim timestamp
+	now = monotonic()
+	sample_period = now - interim[0]
+	if sample_period <= 0:
+		plugin_exit( 0, 'Sample period too short, run again to get values' )
+
+	# rates per second, oom_kill is the number of processes killed in the sample period
+	vm = {}
+	for i in range( len( counters ) ):
+		delta = max( counters[i] - interim[1][i], 0 )
+		if VMSTAT_COUNTERS[i] == 'oom_kill':
+			vm[ VMSTAT_COUNTERS[i] ] = delta
+		else:
+			vm[ VMSTAT_COUNTERS[i] ] = delta / sample_period
+
+	status_outp += 'Major Faults: ' + str( '%.2f' % vm['pgmajfault'] ) + '/s'
+	status_outp += ' Swap In: ' + str( '%.2f' % vm['pswpin'] ) + '/s Out: ' + str( '%.2f' % vm['pswpout'] ) + '/s'
+	status_outp += ' Scan: ' + str( '%.2f' % vm['pgscan'] ) + '/s Steal: ' + str( '%.2f' % vm['pgsteal'] ) + '/s'
+	status_outp += ' Allocstall: ' + str( '%.2f' % vm['allocstall'] ) + '/s'
+	status_outp += ' OOM Kills: ' + str( vm['oom_kill'] )
+	status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
+
+	#thresholds are in the order of VMSTAT_COUNTERS, empty ones are skipped
+	if warn is not None and crit is not None:
+		status_code = 0
+		for i in range( len( warn ) ):
+			if crit[i] !='' and warn[i] !='':
+				if float( vm[ VMSTAT_COUNTERS[i] ] ) >= float( crit[i] ):
+					status_code = 2
+					status_outp += ' (Critical ' + VMSTAT_COUNTERS[i] + ')'
+				elif float( vm[ VMSTAT_COUNTERS[i] ] ) >= float( warn[i] ):
+					if status_code < 1:
+						status_code = 1
+					status_outp += ' (Warning ' + VMSTAT_COUNTERS[i] + ')'
+		if status_code == 0:
+			status_outp += ' (OK)'
+	else:
+		status_code = 0
+
+	seq=0
+	for x in VMSTAT_COUNTERS:
+		if x == 'oom_kill':
+			perfdata += x + '=' + str( vm[x] )
+		else:
+			perfdata += x + '=' + str( '%.2f' % vm[x] )
+		if warn is not None and crit is not None:
+			if len( warn ) >= seq+1:
+				perfdata += ';' + str(warn[seq]) + ';' + str(crit[seq])
+		perfdata += ' '
+		seq = seq + 1
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	#update the interim values
+	set_state( 'vmstat', counters )
+
+	plugin_exit( status_code, status_outp, perfdata )
+
 def check_swap ( warn=None, crit=None ):
 	status_code = 3
 	status_outp =''
 	perfdata = ''
-	swap = {}
-	#with open('/proc/meminfo') as f:
-	f = open('/proc/meminfo', 'r')
-	try:
-		for line in f:
-			if line.startswith('SwapTotal: ' ):
-				swap['total'] = int( line.split()[1] )
-			elif line.startswith('SwapFree: ' ):
-				swap['free'] = int( line.split()[1] )
-			elif line.startswith('SwapCached: ' ):
-				swap['cached'] = int( line.split()[1] )
-	finally:
-		f.close()
+	mem = parse_meminfo( read_proc( PROC_ROOT + '/meminfo' ) )
+	swap = { 'total': mem['SwapTotal'], 'free': mem['SwapFree'], 'cached': mem['SwapCached'] }
 	s = {
 	'total':   float( swap['total'] / 1024.00 ),
 	'cached':  float( swap['cached'] / 1024.00 ),
 	'used':    float( (swap['total'] - swap['free'] - swap['cached']) / 1024.00 ),
-	'used_p':  float( swap['total'] - swap['free'] - swap['cached'] ) / swap['total'] * 100.00
+	'used_p':  0.0
 	}
+	# no swap configured
+	if swap['total'] > 0:
+		s['used_p'] = float( swap['total'] - swap['free'] - swap['cached'] ) / swap['total'] * 100.00
 
 	#status_outp += 'Swap Used: ' + format( s['used'], '.2f' ) + 'MB / ' + format( s['total'], '.2f' ) + 'MB (' + format( s['used_p'], '.2f' ) + '%)'
 	status_outp += 'Swap Used: ' + str( '%.2f' % s['used'] ) + 'MB / ' + str( '%.2f' % s['total'] ) + 'MB (' + str( '%.2f' % s['used_p'] ) + '%)'
@@ -651,294 +2260,1087 @@ def check_swap ( warn=None, crit=None ):
 	#remove last space
 	perfdata = perfdata[:-1]
 
-	print status_outp + ' | ' + perfdata
-	sys.exit( status_code )
+	plugin_exit( status_code, status_outp, perfdata )
+
+def net_ifindex( name ):
+	# ifindex of the interface, 0 where sysfs does not have it
+	try:
+		return int( read_file( NET_SYSFS + '/' + name + '/ifindex' ) )
+	except ( IOError, OSError, ValueError ):
+		return 0
 
 def check_net ( interface, warn=None, crit=None ):
 	status_code = 0
 	status_outp =''
 	perfdata = ''
 
-	#Verify if the interim file exists, if not create it now
-	interim_file = INTERIM_DIR + '/' + 'proc_net_dev_' + interface
-	if not os.path.isfile( interim_file ):
-		shutil.copyfile( '/proc/net/dev', interim_file )
-		print ( 'This was the first run, run again to get values: net:' + interface )
-		sys.exit( 0 )
-
-	# Get mtime of the interim file and calculate the sample period
-	sample_period = float ( time.time() - os.path.getmtime( interim_file ) )
-
-	# Calculate the deltas
-	int_t = {}
-	int_d = {}
-	for file in ['/proc/net/dev', interim_file]:
-		#with open( file ) as f:
-		f = open( file, 'r' )
-		try:
-			for line in f:
-				line = line.strip()
-				if line.startswith( interface+':' ):
-					seq = 0
-					for x in ['r_bytes','r_packets','r_errs','r_drop','r_fifo','r_frame','r_compressed','r_multicast',
-						't_bytes','t_packets','t_errs','t_drop','t_fifo','t_colls','t_carrier','t_compressed']:
-						# if files is current/proc, load values in int_t
-						if file == '/proc/net/dev':
-							int_t[x] = int( line.split( interface+':' )[1].split()[seq] )
-						# if file is interim calculate the diff and load deltas in int_d
-						elif file == interim_file:
-							interim_value = int( line.split( interface+':' )[1].split()[seq] )
-							int_d[x] = int_t[x] - interim_value
-						seq += 1
-					break
-		finally:
-			f.close()
-	if not int_t or not int_d:
+	#Index all interfaces in one pass and pick the requested ones:
+	#comma separated interface names or glob patterns
+	interfaces = parse_net_dev( read_proc( PROC_ROOT + '/net/dev', binary=True ) )
+	names = match_names( interfaces, interface.split( ',' ) )
+	if not names:
 		#interface not found
-		print ( 'Plugin Error: Network device not found: ('+interface+')' )
-		sys.exit( 3 )
-	else:
+		plugin_exit( 3, 'Plugin Error: Network device not found: ('+interface+')' )
+	if len( names ) == 1:
+		device_prefix( '', names[0] )
+
+	state = load_state()
+	now = monotonic()
+	new_state = {}
+	first_run = []
+	reset = []
+	net_d = []
+	for name in names:
+		counters = [ int( x ) for x in interfaces[ name ].split()[:16] ]
+		# the ifindex is kept after the counters, an interface of the same name may be another one
+		identity = net_ifindex( name )
+		state_key = 'net:' + name
+		new_state[ state_key ] = counters + [ identity ]
+		#Verify if the interim values exist, if not save them now
+		interim = get_interim( state, state_key )
+		if interim is None or len( interim[1] ) != len( counters ) + 1 or interim[0] >= now:
+			first_run.append( name )
+			continue
+		# another interface, counters reset or wrapped: start over from the current values or unwrap them
+		deltas = None
+		if interim[1][-1] == identity:
+			deltas = counter_deltas( interim[1][:-1], counters )
+		if deltas is None:
+			reset.append( name )
+			continue
+
+		# Calculate the sample period from the interim timestamp
+		sample_period = now - interim[0]
+
+		# Calculate the deltas
+		int_d = {}
+		seq = 0
+		for x in NET_DEV_FIELDS:
+			int_d[x] = deltas[seq]
+			seq += 1
 		int_d['RX_MBps'] = float( int_d['r_bytes'] / 1024.00 / 1024.00 / sample_period )
 		int_d['TX_MBps'] = float( int_d['t_bytes'] / 1024.00 / 1024.00 / sample_period )
 		int_d['RX_PKps'] = float( int_d['r_packets'] / sample_period )
 		int_d['TX_PKps'] = float( int_d['t_packets'] / sample_period )
+		int_d['PK_ERRORS'] = 0
+		for x in NET_ERROR_FIELDS:
+			int_d['PK_ERRORS'] += int_d[x]
+		net_d.append( ( name, sample_period, int_d ) )
 
-		status_outp += interface
-		#status_outp += ' Rx: ' + format( int_d['RX_MBps'], '.2f' ) + ' MB/s (' + format( int_d['RX_PKps'], '.2f' ) + ' p/s)'
-		#status_outp += ' Tx: ' + format( int_d['TX_MBps'], '.2f' ) + ' MB/s (' + format( int_d['TX_PKps'], '.2f' ) + ' p/s)'
-		#status_outp += ' [t:' + format( sample_period, '.2f' ) + ']'
-		status_outp += ' Rx: ' + str( '%.2f' % int_d['RX_MBps'] ) + ' MB/s (' + str( '%.2f' % int_d['RX_PKps'] ) + ' p/s)'
-		status_outp += ' Tx: ' + str( '%.2f' % int_d['TX_MBps'] ) + ' MB/s (' + str( '%.2f' % int_d['TX_PKps'] ) + ' p/s)'
-		status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
+	#update the interim values of all the interfaces at once
+	update_state( new_state )
+
+	if not net_d and reset:
+		plugin_exit( 0, 'The counters were reset, run again to get values: net:' + ','.join( first_run + reset ) )
+	if not net_d:
+		plugin_exit( 0, 'This was the first run, run again to get values: net:' + ','.join( first_run ) )
 
+	if len( names ) == 1:
+		name, sample_period, total_d = net_d[0]
+		status_outp += name
+	else:
+		# Aggregate of all the interfaces
+		sample_period = net_d[0][1]
+		total_d = {}
+		for x in [ 'RX_MBps', 'TX_MBps', 'RX_PKps', 'TX_PKps', 'PK_ERRORS' ]:
+			total_d[x] = sum( [ d[x] for n, t, d in net_d ] )
+		status_outp += str( len( net_d ) ) + ' interfaces'
+	#status_outp += ' Rx: ' + format( total_d['RX_MBps'], '.2f' ) + ' MB/s (' + format( total_d['RX_PKps'], '.2f' ) + ' p/s)'
+	#status_outp += ' Tx: ' + format( total_d['TX_MBps'], '.2f' ) + ' MB/s (' + format( total_d['TX_PKps'], '.2f' ) + ' p/s)'
+	#status_outp += ' [t:' + format( sample_period, '.2f' ) + ']'
+	status_outp += ' Rx: ' + str( '%.2f' % total_d['RX_MBps'] ) + ' MB/s (' + str( '%.2f' % total_d['RX_PKps'] ) + ' p/s)'
+	status_outp += ' Tx: ' + str( '%.2f' % total_d['TX_MBps'] ) + ' MB/s (' + str( '%.2f' % total_d['TX_PKps'] ) + ' p/s)'
+	status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
+	if first_run:
+		status_outp += ' (First run: ' + ','.join( first_run ) + ')'
+	if reset:
+		status_outp += ' (Counters reset: ' + ','.join( reset ) + ')'
+
+	for name, sample_period, int_d in net_d:
+		if len( names ) == 1:
+			label = ''
+		else:
+			label = name + ' '
 		# Check packet errors
-		int_d['PK_ERRORS'] = 0
-		for x in ['r_errs','r_drop','r_fifo','r_frame',
-			't_errs','t_drop','t_fifo','t_colls','t_carrier']:
+		for x in NET_ERROR_FIELDS:
 			if float( int_d[x] ) > 0:
-				int_d['PK_ERRORS'] += int_d[x]
 				status_code = 2
-				status_outp += ' (Critical ' + x + ':' + str(int_d[x]) + ')'
+				status_outp += ' (Critical ' + label + x + ':' + str(int_d[x]) + ')'
 		# Skip bw checks if packer error
 		if warn is not None and crit is not None and int_d['PK_ERRORS'] == 0:
 			if float( int_d['RX_MBps'] ) >= float( crit[0] ) or float( int_d['TX_MBps'] ) >= float( crit[1] ):
 				status_code = 2
-				status_outp += ' (Critical BW)'
+				status_outp += ' (Critical ' + label + 'BW)'
 			elif float( int_d['RX_MBps'] ) >= float( warn[0] ) or float( int_d['TX_MBps'] ) >= float( warn[1] ):
 				if status_code < 1:
 					status_code = 1
-				status_outp += ' (Warning BW)'
-			else:
+				status_outp += ' (Warning ' + label + 'BW)'
+			elif len( names ) == 1:
 				status_outp += ' (OK)'
-
+	if len( names ) > 1 and warn is not None and crit is not None and status_code == 0:
+		status_outp += ' (OK)'
+
+	# With more than one interface, the aggregate is reported as total_*
+	# and the perfdata labels of each interface are prefixed by its name
+	perf_d = net_d
+	if len( names ) > 1:
+		perf_d = [ ( 'total', 0, total_d ) ] + net_d
+	for name, sample_period, int_d in perf_d:
+		if len( names ) == 1:
+			prefix = ''
+		else:
+			prefix = name + '_'
+			if name != 'total':
+				device_prefix( prefix, name )
 		for x in [ 'RX_MBps', 'RX_PKps', 'TX_MBps', 'TX_PKps', 'PK_ERRORS']:
 			#perfdata += x + '=' + format( int_d[x], '.2f' ) 
-			perfdata += x + '=' + str( '%.2f' % int_d[x] ) 
-			if warn is not None and crit is not None :
+			perfdata += prefix + x + '=' + str( '%.2f' % int_d[x] ) 
+			if warn is not None and crit is not None and name != 'total':
 				if x == 'RX_MBps':
 					perfdata += ';' + str(warn[0]) + ';' + str(crit[0])
 				elif x == 'TX_MBps':
 					perfdata += ';' + str(warn[1]) + ';' + str(crit[1])
 			perfdata += ' '
-		#remove last space
-		perfdata = perfdata[:-1]
+		#peaks within the sample period seen by the sampler
+		if name != 'total':
+			for x in [ 'RX_MBps', 'TX_MBps' ]:
+				perfdata += sampled_perfdata( 'net:' + name + ':' + x, prefix + x, now - sample_period )
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	plugin_exit( status_code, status_outp, perfdata )
+
+def parse_snmp( content ):
+	# { 'Proto:Field': value } of /proc/net/snmp or /proc/net/netstat, where every protocol
+	# has a line of field names followed by a line of values
+	values = {}
+	lines = content.splitlines()
+	for i in range( 0, len( lines ) - 1, 2 ):
+		names = lines[i].split()
+		counters = lines[i+1].split()
+		if not names or names[0] != counters[0]:
+			continue
+		for name, value in zip( names[1:], counters[1:] ):
+			values[ names[0] + name ] = int( value )
+	return values
+
+def check_netproto( warn=None, crit=None ):
+	status_code = 3
+	status_outp =''
+	perfdata = ''
 
-		#update the interim file
-		shutil.copyfile( '/proc/net/dev', interim_file )
+	#Index both files at once, TcpExt of /proc/net/netstat is missing on some kernels
+	snmp = parse_snmp( read_proc( PROC_ROOT + '/net/snmp' ) )
+	try:
+		snmp.update( parse_snmp( read_proc( PROC_ROOT + '/net/netstat' ) ) )
+	except ( IOError, OSError ):
+		pass
+	counters = [ snmp.get( x, 0 ) for x in NETPROTO_COUNTERS ]
+
+	#Verify if the interim values exist, if not save them now
+	interim = get_state( 'netproto' )
+	if interim is None or len( interim[1] ) != len( counters ):
+		set_state( 'netproto', counters )
+		plugin_exit( 0, 'This was the first run, run again to get values' )
+
+	# Calculate the sample period from the interim timestamp
+	sample_period = monotonic() - interim[0]
+	if sample_period <= 0:
+		plugin_exit( 0, 'Sample period too short, run again to get values' )
+
+	delta = dict( [ ( NETPROTO_COUNTERS[i], max( counters[i] - interim[1][i], 0 ) ) for i in range( len( counters ) ) ] )
+	net = {
+		# share of the segments sent that were retransmissions
+		'retrans': 0.0,
+		'retrans_segs': delta['Tcp:RetransSegs'] / sample_period,
+		'active_opens': delta['Tcp:ActiveOpens'] / sample_period,
+		'passive_opens': delta['Tcp:PassiveOpens'] / sample_period,
+		'listen_overflows': delta['TcpExt:ListenOverflows'] / sample_period,
+		'listen_drops': delta['TcpExt:ListenDrops'] / sample_period,
+		'udp_rcvbuf_errors': delta['Udp:RcvbufErrors'] / sample_period,
+		'estab': snmp.get( 'Tcp:CurrEstab', 0 )
+	}
+	if delta['Tcp:OutSegs'] > 0:
+		net['retrans'] = 100.0 * delta['Tcp:RetransSegs'] / delta['Tcp:OutSegs']
 
-		print status_outp + ' | ' + perfdata
-		sys.exit( status_code )
+	status_outp += 'TCP Retrans: ' + str( '%.2f' % net['retrans'] ) + '%'
+	status_outp += ' Opens: ' + str( '%.2f' % net['active_opens'] ) + '/s active ' + str( '%.2f' % net['passive_opens'] ) + '/s passive'
+	status_outp += ' Listen Drops: ' + str( '%.2f' % net['listen_drops'] ) + '/s'
+	status_outp += ' UDP Rcvbuf Errors: ' + str( '%.2f' % net['udp_rcvbuf_errors'] ) + '/s'
+	status_outp += ' Established: ' + str( net['estab'] )
+	status_outp += ' [t:' + str( '%.2f' % sample_period ) + ']'
 
-if __name__ == '__main__':
+	#thresholds are in the order of NETPROTO_THRESHOLDS, empty ones are skipped
+	if warn is not None and crit is not None:
+		status_code = 0
+		for i in range( len( warn ) ):
+			if crit[i] !='' and warn[i] !='':
+				if float( net[ NETPROTO_THRESHOLDS[i] ] ) >= float( crit[i] ):
+					status_code = 2
+					status_outp += ' (Critical ' + NETPROTO_THRESHOLDS[i] + ')'
+				elif float( net[ NETPROTO_THRESHOLDS[i] ] ) >= float( warn[i] ):
+					if status_code < 1:
+						status_code = 1
+					status_outp += ' (Warning ' + NETPROTO_THRESHOLDS[i] + ')'
+		if status_code == 0:
+			status_outp += ' (OK)'
+	else:
+		status_code = 0
 
-	if len( sys.argv ) > 1:
+	for x in [ 'retrans', 'retrans_segs', 'active_opens', 'passive_opens', 'listen_overflows', 'listen_drops', 'udp_rcvbuf_errors', 'estab' ]:
+		if x == 'estab':
+			perfdata += x + '=' + str( net[x] )
+		else:
+			perfdata += x + '=' + str( '%.2f' % net[x] )
+		if x == 'retrans':
+			perfdata += '%'
+		if warn is not None and crit is not None and x in NETPROTO_THRESHOLDS:
+			seq = NETPROTO_THRESHOLDS.index( x )
+			if len( warn ) >= seq+1:
+				perfdata += ';' + str(warn[seq]) + ';' + str(crit[seq])
+		perfdata += ' '
+	#remove last space
+	perfdata = perfdata[:-1]
+
+	#update the interim values
+	set_state( 'netproto', counters )
+
+	plugin_exit( status_code, status_outp, perfdata )
+
+def pop_flag( argv, flag ):
+	# Remove an optional --flag from the arguments, returns True if it was given
+	if flag in argv:
+		argv.remove( flag )
+		return True
+	return False
+
+def pop_option( argv, option ):
+	# Remove an optional --option[=value] from the arguments,
+	# returns the value, '' if it was given without one or None if it was not given
+	for x in argv:
+		if x == option or x.startswith( option + '=' ):
+			argv.remove( x )
+			return x[ len( option ) + 1: ]
+	return None
+
+def start_sampler( interval ):
+	# Start the high resolution sampler, interval is the value of the --sampler option
+	global SAMPLER
+	if interval is None:
+		return
+	if interval == '':
+		interval = SAMPLER_INTERVAL
+	SAMPLER = Sampler( float( interval ) )
+	SAMPLER.start()
+
+def batch_options_end( argv ):
+	# Index of the first check argument of batch and export, only the options before it are theirs:
+	# batch [options] [nagios|nsca] [options] check [args]; ..., export [options] format destination [options] check [args]; ...
+	i = 2
+	while i < len( argv ) and argv[i].startswith( '--' ):
+		i += 1
+	if argv[1] == 'export':
+		i += 2
+	elif i < len( argv ) and argv[i] in [ 'nagios', 'nsca' ]:
+		i += 1
+	while i < len( argv ) and argv[i].startswith( '--' ):
+		i += 1
+	return min( i, len( argv ) )
+
+def run_check( argv ):
+	argv = list( argv )
+	# perfdata label prefix: device, as recorded by device_prefix
+	CHECK_OPTIONS.devices = {}
+	# The options of batch and export are taken from before their checks, the options of the checks are left to them
+	checks = []
+	if len( argv ) > 1 and argv[1] in [ 'batch', 'export' ]:
+		end = batch_options_end( argv )
+		checks = argv[ end: ]
+		argv = argv[ :end ]
+
+	# --profile[=file]: time the phases of the check, reported in the perfdata or appended to file as json
+	destination = pop_option( argv, '--profile' )
+	if destination is not None:
+		profile_check( argv + checks, destination )
+
+	# --window: compute the rates over the given period from the history instead of since the last run
+	window = pop_option( argv, '--window' )
+	CHECK_OPTIONS.window = getattr( CHECK_OPTIONS, 'batch_window', None )
+	if window is not None:
+		CHECK_OPTIONS.window = parse_window( window )
+	argv += checks
+
+	if len( argv ) > 1:
 		# cpu warn crit sample
-		if sys.argv[1] == 'cpu':
+		if argv[1] == 'cpu':
+			core_perfdata = pop_flag( argv, '--per-core-perfdata' )
+			per_core = pop_flag( argv, '--per-core' ) or core_perfdata
 			# no arg passed after cpu
-			if len( sys.argv ) == 2:
-				check_cpu()
+			if len( argv ) == 2:
+				if per_core:
+					check_cpu_cores( core_perfdata=core_perfdata )
+				else:
+					check_cpu()
 			# 2 args passed after cpu; warn,crit
-			elif len( sys.argv ) == 4:
-				if float( sys.argv[3] ) > float( sys.argv[2] ):
-					check_cpu( warn=sys.argv[2], crit=sys.argv[3] )
+			elif len( argv ) == 4:
+				if float( argv[3] ) > float( argv[2] ) and per_core:
+					check_cpu_cores( warn=argv[2], crit=argv[3], core_perfdata=core_perfdata )
+				elif float( argv[3] ) > float( argv[2] ):
+					check_cpu( warn=argv[2], crit=argv[3] )
 				else:
-					print ( 'Plugin Error: Warning('+sys.argv[2]+') threshold should be less than critical('+sys.argv[3]+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[2]+') threshold should be less than critical('+argv[3]+')' )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 	
 		# procs
-		elif sys.argv[1] == 'procs':
+		elif argv[1] == 'procs':
+			threads = pop_flag( argv, '--threads' )
 			# no arg passed after procs
-			if len( sys.argv ) == 2:
-				check_procs()
+			if len( argv ) == 2:
+				check_procs( threads=threads )
 			# if 2 args passed after procs
-			elif len( sys.argv ) == 4:
+			elif len( argv ) == 4:
 				#process comma separated arguments
-				warn_arr = sys.argv[2].split(',')
-				crit_arr = sys.argv[3].split(',')
+				warn_arr = argv[2].split(',')
+				crit_arr = argv[3].split(',')
 				if len(warn_arr) > 3 or len(warn_arr) < 1 or len(warn_arr) != len(crit_arr):
-					print ( 'Plugin Error: Invalide arguments for load: ('+str(sys.argv)+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for load: ('+str(argv)+')' )
 				else:
 					for i in range( len( warn_arr ) ):
 						if warn_arr[i] != '' and crit_arr[i] != '':
 							if float(warn_arr[i]) > float(crit_arr[i]):
-								print ( 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
-								sys.exit( 3 )
-					check_procs( warn=warn_arr, crit=crit_arr )
+								plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+					check_procs( warn=warn_arr, crit=crit_arr, threads=threads )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 				
+		# topprocs [count] [warn% crit%]
+		elif argv[1] == 'topprocs':
+			# no arg passed after topprocs
+			if len( argv ) == 2:
+				check_topprocs()
+			# number of processes to report
+			elif len( argv ) == 3:
+				check_topprocs( int( argv[2] ) )
+			# number of processes, warn, crit
+			elif len( argv ) == 5:
+				if float( argv[4] ) > float( argv[3] ):
+					check_topprocs( int( argv[2] ), warn=argv[3], crit=argv[4] )
+				else:
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[3]+') threshold should be less than critical('+argv[4]+')' )
+			else:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+
 		# load
-		elif sys.argv[1] == 'load':
+		elif argv[1] == 'load':
 			# no arg passed after load
-			if len( sys.argv ) == 2:
+			if len( argv ) == 2:
 				check_load()
 			# if 2 args passed after load
-			elif len( sys.argv ) == 4:
+			elif len( argv ) == 4:
 				#process comma separated arguments
-				warn_arr = sys.argv[2].split(',')
-				crit_arr = sys.argv[3].split(',')
+				warn_arr = argv[2].split(',')
+				crit_arr = argv[3].split(',')
 				if len(warn_arr) > 3 or len(warn_arr) < 1 or len(warn_arr) != len(crit_arr):
-					print ( 'Plugin Error: Invalide arguments for load: ('+str(sys.argv)+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for load: ('+str(argv)+')' )
 				else:
 					for i in range( len( warn_arr ) ):
 						if warn_arr[i] != '' and crit_arr[i] != '':
 							if float(warn_arr[i]) > float(crit_arr[i]):
-								print ( 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
-								sys.exit( 3 )
+								plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
 					check_load( warn=warn_arr, crit=crit_arr )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+		# pressure [cpu|memory|io] [warn(some,full)] [crit(some,full)]
+		elif argv[1] == 'pressure':
+			resource = None
+			if len( argv ) in [ 3, 5 ]:
+				resource = argv.pop( 2 )
+			# no arg passed after pressure [resource]
+			if len( argv ) == 2:
+				check_pressure( resource )
+			# if 2 args passed after pressure [resource]
+			elif len( argv ) == 4:
+				#process comma separated arguments
+				warn_arr = argv[2].split(',')
+				crit_arr = argv[3].split(',')
+				if len(warn_arr) > 2 or len(warn_arr) != len(crit_arr):
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for pressure: ('+str(argv)+')' )
+				for i in range( len( warn_arr ) ):
+					if warn_arr[i] != '' and crit_arr[i] != '':
+						if float(warn_arr[i]) > float(crit_arr[i]):
+							plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+				check_pressure( resource, warn=warn_arr, crit=crit_arr )
+			else:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+		# cgroup cpu|memory|io|procs path[,path...] [warn] [crit]
+		elif argv[1] == 'cgroup':
+			# no arg passed after cgroup resource path
+			if len( argv ) == 4:
+				check_cgroup( argv[2], argv[3] )
+			# if 2 args passed after cgroup resource path; read,write for io
+			elif len( argv ) == 6:
+				warn_arr = argv[4].split(',')
+				crit_arr = argv[5].split(',')
+				if len( warn_arr ) != len( crit_arr ) or len( warn_arr ) != 1 + ( argv[2] == 'io' ):
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for cgroup: ('+str(argv)+')' )
+				for i in range( len( warn_arr ) ):
+					if float(warn_arr[i]) > float(crit_arr[i]):
+						plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+				check_cgroup( argv[2], argv[3], warn=warn_arr, crit=crit_arr )
+			else:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 		# threads
-		elif sys.argv[1] == 'threads':
+		elif argv[1] == 'threads':
 			# no arg passed after procs
-			if len( sys.argv ) == 2:
+			if len( argv ) == 2:
 				check_threads()
 			# if 2 args passed after procs
-			elif len( sys.argv ) == 4:
-				if float( sys.argv[3] ) > float( sys.argv[2] ):
-					check_threads( warn=sys.argv[2], crit=sys.argv[3] )
+			elif len( argv ) == 4:
+				if float( argv[3] ) > float( argv[2] ):
+					check_threads( warn=argv[2], crit=argv[3] )
 				else:
-					print ( 'Plugin Error: Warning('+sys.argv[2]+') threshold should be less than critical('+sys.argv[3]+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[2]+') threshold should be less than critical('+argv[3]+')' )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 				
 		# Open files
-		elif sys.argv[1] == 'files':
+		elif argv[1] == 'files':
 			# no arg passed after procs
-			if len( sys.argv ) == 2:
+			if len( argv ) == 2:
 				check_openfiles()
 			# if 2 args passed after procs
-			elif len( sys.argv ) == 4:
-				if float( sys.argv[3] ) > float( sys.argv[2] ):
-					check_openfiles( warn=sys.argv[2], crit=sys.argv[3] )
+			elif len( argv ) == 4:
+				if float( argv[3] ) > float( argv[2] ):
+					check_openfiles( warn=argv[2], crit=argv[3] )
 				else:
-					print ( 'Plugin Error: Warning('+sys.argv[2]+') threshold should be less than critical('+sys.argv[3]+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[2]+') threshold should be less than critical('+argv[3]+')' )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 		# diskio dev warn(read,write) crit(read,write)
-		elif sys.argv[1] == 'diskio':
+		elif argv[1] == 'diskio':
 			# no arg passed after diskio [dev]
-			if len( sys.argv ) == 3:
-				check_diskio( sys.argv[2] )
+			if len( argv ) == 3:
+				check_diskio( argv[2] )
 			# if 2 args passed after diskio [dev]
-			elif len( sys.argv ) == 5:
+			elif len( argv ) == 5:
 				#process comma separated arguments
 				#we convert it to an array and pass it on
-				warn_arr = sys.argv[3].split(',')
-				crit_arr = sys.argv[4].split(',')
+				warn_arr = argv[3].split(',')
+				crit_arr = argv[4].split(',')
 				if len(warn_arr) != 2 or len(warn_arr) != len(crit_arr):
-					print ( 'Plugin Error: Invalide arguments for ' + sys.argv[1] + ': ('+str(sys.argv)+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for ' + argv[1] + ': ('+str(argv)+')' )
 				else:
 					for i in range( len( warn_arr ) ):
 						if float(warn_arr[i]) > float(crit_arr[i]):
-							print ( 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
-							sys.exit( 3 )
-					check_diskio( sys.argv[2], warn=warn_arr, crit=crit_arr )
+							plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+					check_diskio( argv[2], warn=warn_arr, crit=crit_arr )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 		# disku mount warn crit
-		elif sys.argv[1] == 'disku':
+		elif argv[1] == 'disku':
+			# options of disku all: comma separated file system types and mount point patterns
+			options = {}
+			for x in [ 'fstype', 'include', 'exclude' ]:
+				value = pop_option( argv, '--' + x )
+				if value:
+					options[ x ] = value.split( ',' )
+			timeout = pop_option( argv, '--timeout' )
+			if timeout:
+				options['timeout'] = float( timeout )
+			if len( argv ) > 2 and argv[2] == 'all':
+				disku = lambda mount, warn=None, crit=None: check_disku_all( warn, crit, options.get( 'fstype' ),
+					options.get( 'include' ), options.get( 'exclude' ), options.get( 'timeout', DISKU_TIMEOUT ) )
+			elif options:
+				plugin_exit( 3, 'Plugin Error: Options are only valid for disku all: ('+str(argv)+')' )
+			else:
+				disku = check_disku
 			# no arg passed after disku mount
-			if len( sys.argv ) == 3:
-				check_disku( sys.argv[2] )
+			if len( argv ) == 3:
+				disku( argv[2] )
 			# if 2 args passed after disku mount
-			elif len( sys.argv ) == 5:
-				if float( sys.argv[4] ) > float ( sys.argv[3] ):
-					check_disku( sys.argv[2] , warn=sys.argv[3], crit=sys.argv[4] )
+			elif len( argv ) == 5:
+				if float( argv[4] ) > float ( argv[3] ):
+					disku( argv[2] , warn=argv[3], crit=argv[4] )
 				else:
-					print ( 'Plugin Error: Warning('+sys.argv[2]+') threshold should be less than critical('+sys.argv[3]+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[2]+') threshold should be less than critical('+argv[3]+')' )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 		# memory warn crit
-		elif sys.argv[1] == 'memory':
+		elif argv[1] == 'memory':
+			extended = pop_flag( argv, '--extended' )
 			# no arg passed after memory
-			if len( sys.argv ) == 2:
-				check_memory()
+			if len( argv ) == 2:
+				check_memory( extended=extended )
 			# if 2 args passed after memory
-			elif len( sys.argv ) == 4:
-				if float( sys.argv[3] ) > float( sys.argv[2] ):
-					check_memory( warn=sys.argv[2] , crit=sys.argv[3] )
+			elif len( argv ) == 4:
+				if float( argv[3] ) > float( argv[2] ):
+					check_memory( warn=argv[2] , crit=argv[3], extended=extended )
+				else:
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[2]+') threshold should be less than critical('+argv[3]+')' )
+			else:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+		# netproto warn crit, comma separated in the order retrans%,listen_drops,udp_rcvbuf_errors,estab
+		elif argv[1] == 'netproto':
+			# no arg passed after netproto
+			if len( argv ) == 2:
+				check_netproto()
+			# if 2 args passed after netproto
+			elif len( argv ) == 4:
+				#process comma separated arguments
+				warn_arr = argv[2].split(',')
+				crit_arr = argv[3].split(',')
+				if len(warn_arr) > len( NETPROTO_THRESHOLDS ) or len(warn_arr) != len(crit_arr):
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for netproto: ('+str(argv)+')' )
+				else:
+					for i in range( len( warn_arr ) ):
+						if warn_arr[i] != '' and crit_arr[i] != '':
+							if float(warn_arr[i]) > float(crit_arr[i]):
+								plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+					check_netproto( warn=warn_arr, crit=crit_arr )
+			else:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+		# vmstat warn crit, comma separated in the order pgmajfault,pswpin,pswpout,pgscan,pgsteal,allocstall,oom_kill
+		elif argv[1] == 'vmstat':
+			# no arg passed after vmstat
+			if len( argv ) == 2:
+				check_vmstat()
+			# if 2 args passed after vmstat
+			elif len( argv ) == 4:
+				#process comma separated arguments
+				warn_arr = argv[2].split(',')
+				crit_arr = argv[3].split(',')
+				if len(warn_arr) > len( VMSTAT_COUNTERS ) or len(warn_arr) != len(crit_arr):
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for vmstat: ('+str(argv)+')' )
 				else:
-					print ( 'Plugin Error: Warning('+sys.argv[2]+') threshold should be less than critical('+sys.argv[3]+')' )
-					sys.exit( 3 )
+					for i in range( len( warn_arr ) ):
+						if warn_arr[i] != '' and crit_arr[i] != '':
+							if float(warn_arr[i]) > float(crit_arr[i]):
+								plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+					check_vmstat( warn=warn_arr, crit=crit_arr )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 		# swap warn crit
-		elif sys.argv[1] == 'swap':
+		elif argv[1] == 'swap':
 			# no arg passed after swap
-			if len( sys.argv ) == 2:
+			if len( argv ) == 2:
 				check_swap()
 			# if 2 args passed after swap
-			elif len( sys.argv ) == 4:
-				if float( sys.argv[3] ) > float( sys.argv[2] ):
-					check_swap( warn=sys.argv[2] , crit=sys.argv[3] )
+			elif len( argv ) == 4:
+				if float( argv[3] ) > float( argv[2] ):
+					check_swap( warn=argv[2] , crit=argv[3] )
 				else:
-					print ( 'Plugin Error: Warning('+sys.argv[2]+') threshold should be less than critical('+sys.argv[3]+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Warning('+argv[2]+') threshold should be less than critical('+argv[3]+')' )
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
 	
 		# network iface warn(rx,tx)  crit(rx,tx)
-		elif sys.argv[1] == 'network':
+		elif argv[1] == 'network':
 			# no arg passed after network iface
-			if len( sys.argv ) == 3:
-				check_net( sys.argv[2] )
+			if len( argv ) == 3:
+				check_net( argv[2] )
 			# if 2 args passed after network iface
-			elif len( sys.argv ) == 5:
+			elif len( argv ) == 5:
 				#process comma separated arguments
 				#we convert it to an array and pass it on
-				warn_arr = sys.argv[3].split(',')
-				crit_arr = sys.argv[4].split(',')
+				warn_arr = argv[3].split(',')
+				crit_arr = argv[4].split(',')
 				if len(warn_arr) != 2 or len(warn_arr) != len(crit_arr):
-					print ( 'Plugin Error: Invalide arguments for ' + sys.argv[1] + ': ('+str(sys.argv)+')' )
-					sys.exit( 3 )
+					plugin_exit( 3, 'Plugin Error: Invalide arguments for ' + argv[1] + ': ('+str(argv)+')' )
 				else:
 					for i in range( len( warn_arr ) ):
 						if float(warn_arr[i]) > float(crit_arr[i]):
-							print ( 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
-							sys.exit( 3 )
-					check_net( sys.argv[2], warn=warn_arr, crit=crit_arr )
+							plugin_exit( 3, 'Plugin Error: Warning('+warn_arr[i]+') threshold should be less than critical('+crit_arr[i]+')' )
+					check_net( argv[2], warn=warn_arr, crit=crit_arr )
+			else:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+		# batch [nagios|nsca] check [args]; check [args]; ...
+		elif argv[1] == 'batch':
+			end = batch_options_end( argv )
+			options = argv[ 2:end ]
+			timeout = pop_option( options, '--timeout' )
+			if not timeout:
+				timeout = COLLECT_TIMEOUT
+			output_format = 'nagios'
+			for x in [ 'nagios', 'nsca' ]:
+				if x in options:
+					options.remove( x )
+					output_format = x
+			specs = [ x.split() for x in ' '.join( argv[ end: ] ).split( ';' ) if x.strip() != '' ]
+			if options or not specs:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+			check_batch( specs, output_format, float( timeout ) )
+		# export graphite|influx|prometheus destination check [args]; check [args]; ...
+		elif argv[1] == 'export':
+			if len( argv ) < 5 or argv[2] not in [ 'graphite', 'influx', 'prometheus' ]:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+argv[1]+': ('+str(argv)+')' )
+			specs = [ x.split() for x in ' '.join( argv[4:] ).split( ';' ) if x.strip() != '' ]
+			check_export( specs, argv[2], argv[3] )
+		else:
+			plugin_exit( 3, 'What?' )
+
+def get_check_result( argv ):
+	# Run a check in-process and return ( status_code, output ) instead of exiting
+	try:
+		run_check( argv )
+	except PluginExit:
+		e = sys.exc_info()[1]
+		return ( e.status_code, e.output )
+	except Exception:
+		e = sys.exc_info()[1]
+		return ( 3, 'Plugin Error: ' + str( e ) )
+	return ( 3, 'Plugin Error: No check specified' )
+
+def get_check_metrics( argv, window=None, profile=None ):
+	# get_check_result with the devices of its perfdata label prefixes, ( status_code, output, devices );
+	# run in a thread of its own by a batch, which passes on its --window and --profile: the check
+	# does not see the options of the thread of the batch, the phases are added to the batch profile
+	CHECK_OPTIONS.batch_window = window
+	check_profile = None
+	if profile is not None:
+		check_profile = CHECK_OPTIONS.profile = Profile()
+	try:
+		status_code, output = get_check_result( argv )
+	finally:
+		CHECK_OPTIONS.batch_window = None
+		CHECK_OPTIONS.profile = None
+	if check_profile is not None:
+		profile.merge( check_profile )
+	return ( status_code, output, getattr( CHECK_OPTIONS, 'devices', {} ) )
+
+def profile_check( argv, destination ):
+	# Run the check profiled, the profile is added to the perfdata or, if a destination file is given,
+	# appended to it as a line of json leaving the output of the check as it is
+	profile = Profile()
+	CHECK_OPTIONS.profile = profile
+	start = ( time.time(), cpu_time() )
+	try:
+		status_code, output = get_check_result( argv )
+	finally:
+		CHECK_OPTIONS.profile = None
+	profile.finish( time.time() - start[0], cpu_time() - start[1] )
+	if destination == '':
+		if ' | ' in output:
+			output += ' ' + profile.perfdata()
+		else:
+			output += ' | ' + profile.perfdata()
+		plugin_exit( status_code, output )
+	import json
+	phases = {}
+	for name in profile.phases:
+		wall, cpu, opens = profile.phases[ name ]
+		phases[ name ] = { 'wall_ms': round( wall * 1000, 3 ), 'cpu_ms': round( cpu * 1000, 3 ), 'opens': opens }
+	record = { 'time': round( time.time(), 3 ), 'check': argv[1:], 'status': status_code, 'phases': phases }
+	try:
+		f = open( destination, 'a' )
+		try:
+			f.write( json.dumps( record, sort_keys=True ) + '\n' )
+		finally:
+			f.close()
+	except IOError:
+		e = sys.exc_info()[1]
+		output += '\nProfile not written to ' + destination + ': ' + str( e )
+	plugin_exit( status_code, output )
+
+def worst_status( status_a, status_b ):
+	# Critical > Unknown > Warning > OK
+	order = [ 0, 1, 3, 2 ]
+	if order.index( status_b ) > order.index( status_a ):
+		return status_b
+	return status_a
+
+def run_concurrently( func, calls, timeout, default=None ):
+	# Call func( *args ) for the args of every call concurrently, each in its own thread, returns the results
+	# in the order of calls with raised exceptions as results; a call still running after timeout seconds
+	# (e.g. a statvfs hung on a stale NFS mount) gets default and is left behind, its daemon thread
+	# does not keep the plugin from exiting
+	import threading
+	results = [ None ] * len( calls )
+	done = [ False ] * len( calls )
+
+	def call( i ):
+		try:
+			results[i] = func( *calls[i] )
+		except Exception:
+			results[i] = sys.exc_info()[1]
+		done[i] = True
+
+	threads = []
+	for i in range( len( calls ) ):
+		t = threading.Thread( target=call, args=( i, ) )
+		t.daemon = True
+		t.start()
+		threads.append( t )
+	deadline = monotonic() + timeout
+	for i in range( len( threads ) ):
+		threads[i].join( max( deadline - monotonic(), 0 ) )
+		if not done[i]:
+			results[i] = default
+	return results
+
+def collect_results( argvs, timeout=COLLECT_TIMEOUT ):
+	# Run the checks concurrently, returns [ ( status_code, output, devices ) ] in the order of argvs,
+	# a check that did not finish within timeout seconds is reported as unknown
+	timed_out = ( 3, 'Plugin Error: Check timed out after ' + str( '%.2f' % timeout ) + ' seconds', {} )
+	window = getattr( CHECK_OPTIONS, 'window', None )
+	profile = getattr( CHECK_OPTIONS, 'profile', None )
+	return run_concurrently( get_check_metrics, [ ( x, window, profile ) for x in argvs ], timeout, timed_out )
+
+def run_batch( specs, timeout=COLLECT_TIMEOUT ):
+	# Run the checks concurrently sharing the /proc reads,
+	# returns [ ( spec, service, status_code, output, devices ) ]
+	global PROC_CACHE
+	results = []
+	PROC_CACHE = {}
+	try:
+		argvs = [ [ sys.argv[0] ] + spec for spec in specs if spec[0] not in [ 'batch', 'export' ] ]
+		collected = collect_results( argvs, timeout )
+		for spec in specs:
+			if spec[0] in DEVICE_CHECKS and len( spec ) > 1:
+				service = spec[0] + ' ' + spec[1]
+			else:
+				service = spec[0]
+			if spec[0] in [ 'batch', 'export' ]:
+				result = ( 3, 'Plugin Error: ' + spec[0] + ' can not be nested', {} )
+			else:
+				result = collected.pop( 0 )
+			results.append( ( spec, service ) + tuple( result ) )
+	finally:
+		PROC_CACHE = None
+	return results
+
+def check_batch( specs, output_format='nagios', timeout=COLLECT_TIMEOUT ):
+	results = [ x[1:4] for x in run_batch( specs, timeout ) ]
+
+	# One passive check result per line, as read by send_nsca
+	if output_format == 'nsca':
+		import socket
+		hostname = socket.gethostname()
+		lines = [ hostname + '\t' + service + '\t' + str( code ) + '\t' + output for service, code, output in results ]
+		plugin_exit( 0, '\n'.join( lines ) )
+
+	# Nagios multi-line output: summary, one line per check, perfdata prefixed by the service
+	status_code = 0
+	counts = [ 0, 0, 0, 0 ]
+	status_lines = []
+	perfdata = []
+	for service, code, output in results:
+		status_code = worst_status( status_code, code )
+		counts[ code ] += 1
+		text = output.split( ' | ', 1 )
+		status_lines.append( STATUS_NAMES[ code ] + ' ' + service + ': ' + text[0] )
+		if len( text ) == 2:
+			prefix = ''.join( [ c if c.isalnum() else '_' for c in service ] ) + '_'
+			perfdata += [ prefix + x for x in text[1].split() ]
+
+	status_outp = 'Batch: ' + str( len( results ) ) + ' checks'
+	for code in [ 2, 1, 3 ]:
+		if counts[ code ] > 0:
+			status_outp += ' ' + str( counts[ code ] ) + ' ' + STATUS_NAMES[ code ].lower()
+	status_outp += ' (' + [ 'OK', 'Warning', 'Critical', 'Unknown' ][ status_code ] + ')'
+	status_outp += '\n' + '\n'.join( status_lines )
+	if perfdata:
+		plugin_exit( status_code, status_outp, ' '.join( perfdata ) )
+	plugin_exit( status_code, status_outp )
+
+def parse_perfdata( perfdata ):
+	# [ ( label, value ) ] of a perfdata string, the units and thresholds are dropped
+	metrics = []
+	for x in perfdata.split():
+		label, value = ( x.split( '=', 1 ) + [ '' ] )[0:2]
+		value = value.split( ';' )[0]
+		while value and not value[-1].isdigit():
+			value = value[:-1]
+		try:
+			metrics.append( ( label, float( value ) ) )
+		except ValueError:
+			continue
+	return metrics
+
+def metric_name( name ):
+	return ''.join( [ c if c.isalnum() or c == '_' else '_' for c in name ] )
+
+def format_metrics( results, output_format ):
+	# Format the perfdata and status of the batch results as graphite plaintext,
+	# influx line protocol or prometheus text exposition lines; the perfdata labels prefixed
+	# with a device are split into the device, reported as a tag or label, and the metric name
+	import socket
+	hostname = socket.gethostname()
+	now = time.time()
+	lines = []
+	for spec, service, code, output, devices in results:
+		check = metric_name( spec[0] )
+		prefixes = sorted( [ x for x in devices if x != '' ], key=len, reverse=True )
+		metrics = [ ( devices.get( '', '' ), 'status', code ) ]
+		if ' | ' in output:
+			for label, value in parse_perfdata( output.split( ' | ', 1 )[1] ):
+				device = devices.get( '', '' )
+				for prefix in prefixes:
+					if label.startswith( prefix ):
+						device = devices[ prefix ]
+						label = label[ len( prefix ): ]
+						break
+				metrics.append( ( device, label, value ) )
+		if output_format == 'graphite':
+			for device, label, value in metrics:
+				path = 'linux_metrics.' + metric_name( hostname ) + '.' + check + '.'
+				if device:
+					# mount points and cgroups without their slashes, root for /
+					path += ( metric_name( device.strip( '/' ) ) or 'root' ) + '.'
+				lines.append( path + metric_name( label ) + ' ' + repr( value ) + ' ' + str( int( now ) ) )
+		elif output_format == 'influx':
+			# One line per device
+			order = []
+			fields = {}
+			for device, label, value in metrics:
+				if device not in fields:
+					order.append( device )
+					fields[ device ] = []
+				fields[ device ].append( metric_name( label ) + '=' + repr( float( value ) ) )
+			for device in order:
+				tags = 'linux_metrics,host=' + hostname.replace( ' ', '\\ ' ) + ',check=' + check
+				if device:
+					tags += ',device=' + device.replace( ' ', '\\ ' ).replace( ',', '\\,' ).replace( '=', '\\=' )
+				lines.append( tags + ' ' + ','.join( fields[ device ] ) + ' ' + str( int( now * 1000000000 ) ) )
+		elif output_format == 'prometheus':
+			for device, label, value in metrics:
+				labels = 'host="' + hostname + '"'
+				if device:
+					labels += ',device="' + device.replace( '\\', '\\\\' ).replace( '"', '\\"' ).replace( '\n', '\\n' ) + '"'
+				lines.append( 'linux_metrics_' + check + '_' + metric_name( label ) + '{' + labels + '} ' + repr( float( value ) ) )
+	return '\n'.join( lines ) + '\n'
+
+def write_metrics( data, destination, output_format ):
+	# destination: '-' for stdout, unix:PATH or tcp:HOST:PORT for a socket, or a file
+	if destination.startswith( 'unix:' ) or destination.startswith( 'tcp:' ):
+		import socket
+		if destination.startswith( 'unix:' ):
+			s = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+			address = destination[5:]
+		else:
+			s = socket.socket( socket.AF_INET, socket.SOCK_STREAM )
+			host, port = destination[4:].rsplit( ':', 1 )
+			address = ( host, int( port ) )
+		s.settimeout( 10 )
+		try:
+			s.connect( address )
+			s.sendall( data.encode( 'utf-8' ) )
+		finally:
+			s.close()
+	# A prometheus textfile is replaced atomically, other formats are appended
+	elif output_format == 'prometheus':
+		tmp_file = destination + '.' + str( os.getpid() )
+		f = open( tmp_file, 'w' )
+		try:
+			f.write( data )
+		finally:
+			f.close()
+		os.rename( tmp_file, destination )
+	else:
+		f = open( destination, 'a' )
+		try:
+			f.write( data )
+		finally:
+			f.close()
+
+def check_export( specs, output_format, destination ):
+	results = run_batch( specs )
+	data = format_metrics( results, output_format )
+	if destination == '-':
+		plugin_exit( 0, data.rstrip( '\n' ) )
+	try:
+		write_metrics( data, destination, output_format )
+	except ( IOError, OSError ):
+		e = sys.exc_info()[1]
+		plugin_exit( 3, 'Plugin Error: Could not write the metrics to ' + destination + ': ' + str( e ) )
+	plugin_exit( 0, 'Exported ' + str( data.count( '\n' ) ) + ' ' + output_format + ' lines of ' + str( len( results ) ) + ' checks to ' + destination )
+
+def daemon( socket_path=DAEMON_SOCKET, interval=0 ):
+	import signal
+	import threading
+	try:
+		import socketserver
+	except ImportError:
+		import SocketServer as socketserver
+
+	# Cached results of every check spec requested so far,
+	# the lock serialises check runs as they share the interim state
+	results = {}
+	lock = threading.Lock()
+
+	def execute( spec ):
+		lock.acquire()
+		try:
+			results[ spec ] = get_check_result( [ sys.argv[0] ] + list( spec ) )
+			return results[ spec ]
+		finally:
+			lock.release()
+
+	class CheckHandler( socketserver.StreamRequestHandler ):
+		def handle( self ):
+			request = self.rfile.readline().decode( 'utf-8' ).strip( '\n' )
+			spec = tuple( request.split( '\t' ) )
+			# The clients only get to run checks, not the subcommands or a --profile writing files
+			if spec[0] not in DAEMON_CHECKS:
+				result = ( 3, 'Plugin Error: Not a check: ' + spec[0] )
+			elif [ x for x in spec if x.startswith( '--profile=' ) ]:
+				result = ( 3, 'Plugin Error: --profile=file is not allowed through the daemon' )
+			# With a sampling interval, answer from the last scheduled run
+			elif interval > 0 and spec in results:
+				result = results[ spec ]
 			else:
-				print ( 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
-				sys.exit( 3 )
+				result = execute( spec )
+			self.wfile.write( ( str( result[0] ) + '\n' + result[1] ).encode( 'utf-8' ) )
+
+	class CheckServer( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+		daemon_threads = True
+
+	def scheduler():
+		while True:
+			time.sleep( interval )
+			for spec in list( results.keys() ):
+				execute( spec )
+
+	make_interim_dir()
+	if os.path.exists( socket_path ):
+		os.remove( socket_path )
+	# The umask keeps the socket closed between its bind and the chmod
+	umask = os.umask( 0o177 )
+	try:
+		server = CheckServer( socket_path, CheckHandler )
+	finally:
+		os.umask( umask )
+	os.chmod( socket_path, DAEMON_SOCKET_MODE )
+	# Exit cleanly on TERM so that the socket is removed
+	signal.signal( signal.SIGTERM, lambda signum, frame: sys.exit( 0 ) )
+	if interval > 0:
+		t = threading.Thread( target=scheduler )
+		t.daemon = True
+		t.start()
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+		os.remove( socket_path )
+
+def exporter( address='', port=EXPORTER_PORT, ttl=EXPORTER_TTL, specs=EXPORTER_CHECKS ):
+	global STATE_FILE
+	try:
+		from http.server import HTTPServer, BaseHTTPRequestHandler
+		from socketserver import ThreadingMixIn
+	except ImportError:
+		from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+		from SocketServer import ThreadingMixIn
+	import threading
+
+	# Keep the interim values apart from the ones of the nagios checks
+	STATE_FILE = INTERIM_DIR + '/state.exporter'
+
+	# The metrics of the last collection, concurrent scrapes within the ttl share it
+	cache = { 'time': None, 'data': '' }
+	lock = threading.Lock()
+
+	def collect():
+		lock.acquire()
+		try:
+			now = monotonic()
+			if cache['time'] is None or now - cache['time'] >= ttl:
+				cache['data'] = format_metrics( run_batch( specs ), 'prometheus' )
+				cache['time'] = now
+			return cache['data']
+		finally:
+			lock.release()
+
+	class MetricsHandler( BaseHTTPRequestHandler ):
+		def do_GET( self ):
+			if self.path.split( '?', 1 )[0] != '/metrics':
+				self.send_error( 404 )
+				return
+			data = collect().encode( 'utf-8' )
+			self.send_response( 200 )
+			self.send_header( 'Content-Type', 'text/plain; version=0.0.4' )
+			self.send_header( 'Content-Length', str( len( data ) ) )
+			self.end_headers()
+			self.wfile.write( data )
+
+		def log_message( self, format, *args ):
+			pass
+
+	class MetricsServer( ThreadingMixIn, HTTPServer ):
+		daemon_threads = True
+
+	server = MetricsServer( ( address, port ), MetricsHandler )
+	try:
+		server.serve_forever()
+	finally:
+		server.server_close()
+
+def client( socket_path, args ):
+	import socket
+	s = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+	s.settimeout( 30 )
+	response = b''
+	try:
+		try:
+			s.connect( socket_path )
+			s.sendall( ( '\t'.join( args ) + '\n' ).encode( 'utf-8' ) )
+			while True:
+				chunk = s.recv( 4096 )
+				if not chunk:
+					break
+				response += chunk
+		except socket.error:
+			e = sys.exc_info()[1]
+			plugin_exit( 3, 'Plugin Error: Daemon not reachable on ' + socket_path + ': ' + str( e ) )
+	finally:
+		s.close()
+	status_code, output = response.decode( 'utf-8' ).split( '\n', 1 )
+	plugin_exit( int( status_code ), output )
+
+if __name__ == '__main__':
+
+	try:
+		# daemon [--sampler[=seconds]] [socket] [interval]
+		if len( sys.argv ) > 1 and sys.argv[1] == 'daemon':
+			start_sampler( pop_option( sys.argv, '--sampler' ) )
+			if len( sys.argv ) > 4:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
+			socket_path = DAEMON_SOCKET
+			interval = 0
+			if len( sys.argv ) >= 3:
+				socket_path = sys.argv[2]
+			if len( sys.argv ) == 4:
+				interval = float( sys.argv[3] )
+			daemon( socket_path, interval )
+		# exporter [--sampler[=seconds]] [[address:]port] [ttl] [check [args]; check [args]; ...]
+		elif len( sys.argv ) > 1 and sys.argv[1] == 'exporter':
+			start_sampler( pop_option( sys.argv, '--sampler' ) )
+			address = ''
+			port = EXPORTER_PORT
+			ttl = EXPORTER_TTL
+			specs = EXPORTER_CHECKS
+			if len( sys.argv ) >= 3:
+				if ':' in sys.argv[2]:
+					address, port = sys.argv[2].rsplit( ':', 1 )
+				else:
+					port = sys.argv[2]
+			if len( sys.argv ) >= 4:
+				ttl = float( sys.argv[3] )
+			if len( sys.argv ) >= 5:
+				specs = [ x.split() for x in ' '.join( sys.argv[4:] ).split( ';' ) if x.strip() != '' ]
+			exporter( address, int( port ), ttl, specs )
+		# client [socket] check [args]
+		elif len( sys.argv ) > 1 and sys.argv[1] == 'client':
+			socket_path = DAEMON_SOCKET
+			args = sys.argv[2:]
+			if args and args[0].startswith( '/' ):
+				socket_path = args.pop( 0 )
+			if not args:
+				plugin_exit( 3, 'Plugin Error: Invalide arguments for '+sys.argv[1]+': ('+str(sys.argv)+')' )
+			client( socket_path, args )
 		else:
-			print ( 'What?' )
-			sys.exit( 3 )
-		
+			run_check( sys.argv )
+	except PluginExit:
+		e = sys.exc_info()[1]
+		print ( e.output )
+		sys.exit( e.status_code )
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+# File: check_linux_metrics_client.py
+# URL: https://github.com/kxr/check_linux_metrics
+#
+# Minimal client of the check_linux_metrics.py daemon, for the checks run every few seconds
+# without loading the whole plugin: the request is the check and its arguments separated by tabs
+# on one line, the response the status code on the first line and the output of the check
+#
+#  Copyright (c) 2015 Khizer Naeem (http://kxr.me)
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import os
+import socket
+
+DAEMON_SOCKET = os.environ.get( 'LINUX_METRICS_DIR', '/var/tmp/linux_metrics' ) + '/daemon.sock'
+
+# [socket] check [args]
+args = sys.argv[1:]
+socket_path = DAEMON_SOCKET
+if args and args[0].startswith( '/' ):
+	socket_path = args.pop( 0 )
+if not args:
+	print ( 'Plugin Error: Invalide arguments: ('+str(sys.argv)+')' )
+	sys.exit( 3 )
+
+s = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+s.settimeout( 30 )
+response = b''
+try:
+	try:
+		s.connect( socket_path )
+		s.sendall( ( '\t'.join( args ) + '\n' ).encode( 'utf-8' ) )
+		while True:
+			chunk = s.recv( 4096 )
+			if not chunk:
+				break
+			response += chunk
+	except socket.error:
+		e = sys.exc_info()[1]
+		print ( 'Plugin Error: Daemon not reachable on ' + socket_path + ': ' + str( e ) )
+		sys.exit( 3 )
+finally:
+	s.close()
+
+status_code, output = ( response.decode( 'utf-8' ).split( '\n', 1 ) + [ '' ] )[0:2]
+print ( output )
+sys.exit( int( status_code ) if status_code.isdigit() else 3 )